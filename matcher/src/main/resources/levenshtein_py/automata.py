@@ -1,74 +1,33 @@
 import bisect
+import itertools
+import json
+import logging
+import os
 import re
-from itertools import combinations
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-class NFA(object):
-    EPSILON = object()
-    ANY = object()
+logger = logging.getLogger(__name__)
 
-    def __init__(self, start_state):
-        self.transitions = {}
-        self.final_states = set()
-        self._start_state = start_state
-
-    @property
-    def start_state(self):
-        return frozenset(self._expand({self._start_state}))
-
-    def add_transition(self, src, input, dest):
-        self.transitions.setdefault(src, {}).setdefault(input, set()).add(dest)
+try:
+    unichr
+except NameError:
+    unichr = chr
 
-    def add_final_state(self, state):
-        self.final_states.add(state)
 
-    def is_final(self, states):
-        return self.final_states.intersection(states)
-
-    def _expand(self, states):
-        frontier = set(states)
-        while frontier:
-            state = frontier.pop()
-            new_states = self.transitions.get(state, {}).get(NFA.EPSILON, set()).difference(states)
-            frontier.update(new_states)
-            states.update(new_states)
-        return states
-
-    def next_state(self, states, input):
-        dest_states = set()
-        for state in states:
-            state_transitions = self.transitions.get(state, {})
-            dest_states.update(state_transitions.get(input, []))
-            dest_states.update(state_transitions.get(NFA.ANY, []))
-        return frozenset(self._expand(dest_states))
-
-    def get_inputs(self, states):
-        inputs = set()
-        for state in states:
-            inputs.update(self.transitions.get(state, {}).keys())
-        return inputs
-
-    def to_dfa(self):
-        dfa = DFA(self.start_state)
-        frontier = [self.start_state]
-        seen = set()
-        while frontier:
-            current = frontier.pop()
-            inputs = self.get_inputs(current)
-            for input in inputs:
-                if input == NFA.EPSILON:
-                    continue
-                new_state = self.next_state(current, input)
-                if new_state not in seen:
-                    frontier.append(new_state)
-                    seen.add(new_state)
-                    if self.is_final(new_state):
-                        dfa.add_final_state(new_state)
-                if input == NFA.ANY:
-                    dfa.set_default_transition(current, new_state)
-                else:
-                    dfa.add_transition(current, input, new_state)
-        return dfa
+def _iteritems(d):
+    return d.iteritems() if hasattr(d, 'iteritems') else d.items()
 
 
 class DFA(object):
@@ -139,33 +98,327 @@ class DFA(object):
         return None
 
 
-def levenshtein_automata(term):
-    k = 2
-
-    nfa = NFA((0, 0))
-    for i, c in enumerate(term):
-        for e in range(k + 1):
-            # Correct character
-            nfa.add_transition((i, e), c, (i + 1, e))
-            if e < k:
+class LevenshteinTable(object):
+    # Parametric Levenshtein automaton (Schulz & Mihov). A state is a subsumption-reduced set of
+    # positions `(d, e)`: `d` term characters past the state base consumed with `e` edits.
+    # Transitions depend only on the state, the count of term characters left (capped by
+    # `width`) and the characteristic bit-vector of the input character over the next `width`
+    # term characters, so the tables are computed once for all terms.
+
+    def __init__(self, max_edits):
+        self.max_edits = max_edits
+        self.width = 2 * max_edits + 1
+        self.states = []
+        # transitions[window][state][vector] -> (state, shift), where state is -1 when dead
+        self.transitions = [[] for _ in range(self.width + 1)]
+        self.finals = [[] for _ in range(self.width + 1)]
+        # distances[window][state]: edit distance of the strings accepted in a final state
+        self.distances = [[] for _ in range(self.width + 1)]
+        # min_edits[state]: lower bound of the distance of the strings through the state
+        self.min_edits = []
+        self.defaults = []
+
+        state_ids = {}
+
+        def state_id(positions):
+            if positions not in state_ids:
+                state_ids[positions] = len(self.states)
+                self.states.append(positions)
+            return state_ids[positions]
+
+        state_id(frozenset([(0, 0)]))
+        idx = 0
+        while idx < len(self.states):
+            positions = self.states[idx]
+            max_offset = max(d for d, _ in positions)
+            self.min_edits.append(min(e for _, e in positions))
+            self.defaults.append(self.min_edits[-1] < max_edits)
+            for window in range(self.width + 1):
+                if max_offset > window:
+                    self.transitions[window].append(None)
+                    self.finals[window].append(False)
+                    self.distances[window].append(None)
+                    continue
+                row = []
+                for vector in range(1 << window):
+                    next_positions, shift = self._step(positions, window, vector)
+                    row.append((-1, 0) if next_positions is None else (state_id(next_positions), shift))
+                self.transitions[window].append(row)
+                distance = min(e + window - d for d, e in positions)
+                self.finals[window].append(distance <= max_edits)
+                self.distances[window].append(distance if distance <= max_edits else None)
+            idx += 1
+
+    def _step(self, positions, window, vector):
+        max_edits = self.max_edits
+        moved = set()
+        for d, e in positions:
+            for j in range(max_edits - e + 1):
+                # Skip `j` term characters (insertions), then match
+                if d + j < window and vector >> (d + j) & 1:
+                    moved.add((d + j + 1, e + j))
+                    break
+            if e < max_edits:
                 # Deletion
-                nfa.add_transition((i, e), NFA.ANY, (i, e + 1))
-                # Insertion
-                nfa.add_transition((i, e), NFA.EPSILON, (i + 1, e + 1))
+                moved.add((d, e + 1))
+                if d < window:
+                    # Substitution
+                    moved.add((d + 1, e + 1))
+        reduced = [(d, e) for d, e in moved
+                   if not any(f < e and abs(c - d) <= e - f for c, f in moved)]
+        if not reduced:
+            return None, 0
+        shift = min(d for d, _ in reduced)
+        return frozenset((d - shift, e) for d, e in reduced), shift
+
+
+_LEVENSHTEIN_TABLES = dict((max_edits, LevenshteinTable(max_edits)) for max_edits in (1, 2))
+
+
+class LevenshteinDFA(DFA):
+    # States are `(base, state)`: `state` of `LevenshteinTable` shifted by `base` term characters
+
+    def __init__(self, term, max_edits=2):
+        self.term = term
+        self.max_edits = max_edits
+        self.table = _LEVENSHTEIN_TABLES[max_edits]
+        self.start_state = (0, 0)
+        self.masks = {}
+        for i, c in enumerate(term):
+            self.masks[c] = self.masks.get(c, 0) | (1 << i)
+        self.windows = [min(self.table.width, len(term) - base) for base in range(len(term) + 1)]
+        self.labels = {}
+
+    def is_final(self, state):
+        if state is None:
+            return False
+        base, state = state
+        return self.table.finals[self.windows[base]][state]
+
+    def next_state(self, src, input):
+        base, state = src
+        window = self.windows[base]
+        vector = (self.masks.get(input, 0) >> base) & ((1 << window) - 1)
+        state, shift = self.table.transitions[window][state][vector]
+        if state < 0:
+            return None
+        return base + shift, state
+
+    def min_distance(self, state):
+        return self.table.min_edits[state[1]]
+
+    def distance(self, state):
+        base, state = state
+        return self.table.distances[self.windows[base]][state]
+
+    def find_next_edge(self, s, x):
+        if x is None:
+            x = u'\0'
+        else:
+            x = unichr(ord(x) + 1)
+        if self.table.defaults[s[1]]:
+            return x
+        labels = self.state_labels(s)
+        pos = bisect.bisect_left(labels, x)
+        if pos < len(labels):
+            return labels[pos]
+        return None
+
+    def state_labels(self, s):
+        if s not in self.labels:
+            base, state = s
+            labels = set()
+            for d, e in self.table.states[state]:
+                for j in range(self.table.max_edits - e + 1):
+                    if base + d + j < len(self.term):
+                        labels.add(self.term[base + d + j])
+            self.labels[s] = sorted(labels)
+        return self.labels[s]
+
+
+def levenshtein_automata(term, max_edits=2):
+    return LevenshteinDFA(term, max_edits)
+
+
+def _allowed_edits(word_part_len):
+    if word_part_len < 6:
+        return 0
+    elif word_part_len < 11:
+        return 1
+    else:
+        return 2
+
+
+class PartBudgetAutomaton(object):
+    # Accepts exactly the candidates that pass `_matching_threshold` against `term`. Space
+    # characters are part boundaries, and each part may only spend its own length-based edit
+    # budget. A state is a set of positions `(mode, part, i, e)`, where `i` indexes the term with
+    # spaces removed and `e` counts edits spent on the current part:
+    # - mode 0 glues consecutive term parts into the current candidate part, starting at `part`
+    # - mode 1 matches term part `part` against candidate parts glued by dropping their spaces
+    # States are numbered and built lazily.
+
+    def __init__(self, term):
+        parts = term.split(' ')
+        self.chars = ''.join(parts)
+        self.alphabet = set(self.chars)
+        self.starts = []
+        self.ends = []
+        for part in parts:
+            self.starts.append(self.ends[-1] if self.ends else 0)
+            self.ends.append(self.starts[-1] + len(part))
+        self.last = len(parts) - 1
+        self.budgets = [_allowed_edits(len(part)) for part in parts]
+        # glued_budgets[s][t]: edits left to term parts `s..t` glued together
+        self.glued_budgets = [
+            [_allowed_edits(self.ends[t] - self.starts[s]) - (t - s) for t in range(len(parts))]
+            for s in range(len(parts))
+        ]
+        self.glued_caps = [max(budgets[s:]) for s, budgets in enumerate(self.glued_budgets)]
+        # Positions of every state, and per state memoized transitions by input character
+        self.states = []
+        self.state_ids = {}
+        self.transitions = []
+        self.finals = []
+        self.start_state = self._state_id(frozenset([(0, 0, 0, 0), (1, 0, 0, 0)]))
+
+    def _state_id(self, positions):
+        if positions not in self.state_ids:
+            self.state_ids[positions] = len(self.states)
+            self.states.append(positions)
+            self.transitions.append({})
+            self.finals.append(any(self._closes(position, self.last) for position in positions))
+        return self.state_ids[positions]
+
+    def is_final(self, state):
+        return state is not None and self.finals[state]
+
+    def next_state(self, src, input):
+        transitions = self.transitions[src]
+        if input in transitions:
+            return transitions[input]
+        if input != ' ' and input not in self.alphabet:
+            # Characters absent from the term all lead to the same state
+            key = None
+        else:
+            key = input
+        if key not in transitions:
+            positions = set()
+            for position in self.states[src]:
+                if key == ' ':
+                    self._split(position, positions)
+                else:
+                    self._advance(position, key, positions)
+            positions = self._reduce(positions)
+            transitions[key] = None if positions is None else self._state_id(positions)
+        transitions[input] = transitions[key]
+        return transitions[input]
+
+    def _closes(self, position, part_end):
+        mode, part, i, e = position
+        if i > self.ends[part_end] or (mode == 1 and part != part_end):
+            return False
+        budget = self.glued_budgets[part][part_end] if mode == 0 else self.budgets[part]
+        return e + self.ends[part_end] - i <= budget
+
+    def _advance(self, position, c, positions):
+        mode, part, i, e = position
+        if mode == 0:
+            limit, budget = len(self.chars), self.glued_caps[part]
+        else:
+            limit, budget = self.ends[part], self.budgets[part]
+        for j in range(budget - e + 1):
+            # Skip `j` term characters (insertions), then match
+            if i + j < limit and self.chars[i + j] == c:
+                positions.add((mode, part, i + j + 1, e + j))
+                break
+        if e < budget:
+            # Deletion
+            positions.add((mode, part, i, e + 1))
+            if i < limit:
                 # Substitution
-                nfa.add_transition((i, e), NFA.ANY, (i + 1, e + 1))
-    for e in range(k + 1):
-        if e < k:
-            nfa.add_transition((len(term), e), NFA.ANY, (len(term), e + 1))
-        nfa.add_final_state((len(term), e))
-    return nfa
+                positions.add((mode, part, i + 1, e + 1))
+
+    def _split(self, position, positions):
+        mode, part, i, e = position
+        if mode == 0:
+            for part_end in range(part, self.last):
+                if self._closes(position, part_end):
+                    positions.add((0, part_end + 1, self.ends[part_end], 0))
+        else:
+            if e < self.budgets[part]:
+                # The space glues two candidate parts
+                positions.add((1, part, i, e + 1))
+            if part < self.last and self._closes(position, part):
+                positions.add((1, part + 1, self.ends[part], 0))
+
+    @staticmethod
+    def _reduce(positions):
+        # `(mode, part, i, e)` makes `(mode, part, j, f)` redundant when `i <= j` and
+        # `e + j - i <= f`: skipping term characters is all the latter can do in addition
+        reduced = []
+        group = None
+        for mode, part, j, f in sorted(positions):
+            if group != (mode, part):
+                group = (mode, part)
+                slack = None
+            if slack is None or slack > f - j:
+                reduced.append((mode, part, j, f))
+                slack = f - j
+        return frozenset(reduced) or None
+
+
+class ProductAutomaton(object):
+    # Intersection of two automata: a string is accepted when both of them accept it
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        self.term = first.term
+        self.max_edits = first.max_edits
+        self.start_state = (first.start_state, second.start_state)
+
+    def is_final(self, state):
+        return state is not None and self.first.is_final(state[0]) and self.second.is_final(state[1])
+
+    def min_distance(self, state):
+        return self.first.min_distance(state[0])
+
+    def distance(self, state):
+        return self.first.distance(state[0])
+
+    def next_state(self, src, input):
+        first = self.first.next_state(src[0], input)
+        if first is None:
+            return None
+        second = self.second.next_state(src[1], input)
+        if second is None:
+            return None
+        return first, second
+
 
+class Word(object):
+    __slots__ = ('stem', 'suffix')
 
-class Word:
     def __init__(self, stem, suffix):
         self.stem = stem
         self.suffix = suffix
 
+    def __eq__(self, other):
+        return isinstance(other, Word) and self.stem == other.stem and self.suffix == other.suffix
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Word(stem=%r, suffix=%r)' % (self.stem, self.suffix)
+
+
+def _suffixes_by_length(suffixes):
+    # `(length, suffixes)` pairs, the longest suffixes first
+    lengths = sorted(set(len(suffix) for suffix in suffixes), reverse=True)
+    return [(length, frozenset(suffix for suffix in suffixes if len(suffix) == length)) for length in lengths]
+
 
 class LatinStemmer:
     __que_exceptions = {
@@ -184,11 +437,43 @@ class LatinStemmer:
         "a", "e", "i", "o", "u"
     ]
 
+    # Suffixes by length, the longest first. A word ends with at most one suffix of each length, so
+    # the first suffix of `__noun_suffixes` a word ends with is found with a lookup per length.
+    __noun_suffixes_by_length = _suffixes_by_length(__noun_suffixes)
+
+    # Stems of the recently stemmed words, cleared when it holds `MEMO_SIZE` words
+    MEMO_SIZE = 100000
+    __memo = {}
+
     def __init__(self):
         pass
 
     @staticmethod
     def stemmize(word):
+        memo = LatinStemmer.__memo
+        stemmed = memo.get(word)
+        if stemmed is None:
+            if len(memo) >= LatinStemmer.MEMO_SIZE:
+                memo.clear()
+            stemmed = memo[word] = LatinStemmer.__stemmize(word)
+        return stemmed
+
+    @staticmethod
+    def stemmize_many(words):
+        # `stemmize` of every word of `words`. Every distinct word is stemmed once, without going
+        # through the memo of `stemmize`.
+        stemmize = LatinStemmer.__stemmize
+        stemmed = {}
+        res = []
+        for word in words:
+            word_stemmed = stemmed.get(word)
+            if word_stemmed is None:
+                word_stemmed = stemmed[word] = stemmize(word)
+            res.append(word_stemmed)
+        return res
+
+    @staticmethod
+    def __stemmize(word):
         word = word.replace('j', 'i').replace('v', 'u')
 
         if word.endswith('que'):
@@ -196,174 +481,1050 @@ class LatinStemmer:
                 return Word(stem=word, suffix='')
             word = word[:-3]
 
-        for noun_suffix in LatinStemmer.__noun_suffixes:
-            if word.endswith(noun_suffix):
-                if len(word) - len(noun_suffix) >= 2:
-                    return Word(stem=word[:-len(noun_suffix)], suffix=noun_suffix)
+        for length, noun_suffixes in LatinStemmer.__noun_suffixes_by_length:
+            noun_suffix = word[-length:]
+            if noun_suffix in noun_suffixes:
+                if len(word) - length >= 2:
+                    return Word(stem=word[:-length], suffix=noun_suffix)
                 else:
                     return Word(stem=word, suffix='')
 
         return Word(stem=word, suffix='')
 
 
-class Matcher(object):
-    def __init__(self, l):
-        self.l = l
-        self.probes = 0
+_text_type = type(u'')
+
+
+def _to_text(s):
+    return s if isinstance(s, _text_type) else s.decode('utf-8')
+
+
+class StringTable(object):
+    # Read-only sequence of strings kept as one UTF-8 blob and the end offset of every string
+    __slots__ = ('blob', 'offset', 'ends')
+
+    def __init__(self, blob, offset, ends):
+        self.blob = blob
+        self.offset = offset
+        self.ends = ends
+
+    @classmethod
+    def from_strings(cls, strings):
+        blob = []
+        ends = array('l')
+        end = 0
+        for s in strings:
+            s = _to_text(s).encode('utf-8')
+            blob.append(s)
+            end += len(s)
+            ends.append(end)
+        return cls(b''.join(blob), 0, ends)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, idx):
+        start = self.ends[idx - 1] if idx > 0 else 0
+        return self.blob[self.offset + start:self.offset + self.ends[idx]].decode('utf-8')
+
+    def __iter__(self):
+        blob, offset, start = self.blob, self.offset, 0
+        for end in self.ends:
+            yield blob[offset + start:offset + end].decode('utf-8')
+            start = end
+
+    def index(self, s):
+        # Position of `s` in the sorted table, or -1
+        s = _to_text(s)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self[lo] == s:
+            return lo
+        return -1
+
+
+class Postings(object):
+    # Read-only lists of ints kept as one array of values and the end offset of every list
+    __slots__ = ('ends', 'values')
+
+    def __init__(self, ends, values):
+        self.ends = ends
+        self.values = values
+
+    @classmethod
+    def from_lists(cls, lists):
+        values = array('i')
+        ends = array('l')
+        for values_list in lists:
+            values.extend(values_list)
+            ends.append(len(values))
+        return cls(ends, values)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, idx):
+        start = self.ends[idx - 1] if idx > 0 else 0
+        return self.values[start:self.ends[idx]]
+
+
+class NameTable(object):
+    # Names sorted by code point, the id of a name is its position in `names`. The datasources of
+    # name `n` are the bits of `bitmaps[bitmap_ids[n]]`, `bits` has the bit of every datasource.
+    # Equal bitmaps are shared.
+    __slots__ = ('names', 'bits', 'bitmaps', 'bitmap_ids')
 
-    def __call__(self, w):
-        self.probes += 1
-        pos = bisect.bisect_left(self.l, w)
-        if pos < len(self.l):
-            return self.l[pos]
-        else:
+    def __init__(self, words_to_datasources):
+        items = sorted((_to_text(word), data_sources) for word, data_sources in _iteritems(words_to_datasources))
+        self.names = StringTable.from_strings(word for word, _ in items)
+        self.bits = {}
+        for _, data_sources in items:
+            for data_source in data_sources:
+                if data_source not in self.bits:
+                    self.bits[data_source] = 1 << len(self.bits)
+
+        self.bitmaps = []
+        bitmap_ids = {}
+        self.bitmap_ids = array('i')
+        for _, data_sources in items:
+            bitmap = self.bitmap(data_sources)
+            if bitmap not in bitmap_ids:
+                bitmap_ids[bitmap] = len(self.bitmaps)
+                self.bitmaps.append(bitmap)
+            self.bitmap_ids.append(bitmap_ids[bitmap])
+
+    def __len__(self):
+        return len(self.names)
+
+    def name(self, name_id):
+        return self.names[name_id]
+
+    def name_id(self, name):
+        return self.names.index(name)
+
+    def bitmap(self, data_sources):
+        bitmap = 0
+        for data_source in data_sources:
+            bitmap |= self.bits.get(data_source, 0)
+        return bitmap
+
+    def mask(self, data_sources):
+        # Bitmap to filter by `data_sources`, or None when there is nothing to filter
+        if not data_sources:
             return None
+        return self.bitmap(data_sources)
+
+    def data_sources(self, name_id):
+        bitmap = self.bitmaps[self.bitmap_ids[name_id]]
+        return set(data_source for data_source, bit in self.bits.items() if bitmap & bit)
+
+    def union(self, name_ids):
+        bitmap = 0
+        for name_id in name_ids:
+            bitmap |= self.bitmaps[self.bitmap_ids[name_id]]
+        return bitmap
+
+    def filter(self, name_ids, mask):
+        # Names of `name_ids` with any of the datasources of `mask`
+        if mask is None:
+            return [self.names[name_id] for name_id in name_ids]
+        bitmaps, bitmap_ids = self.bitmaps, self.bitmap_ids
+        return [self.names[name_id] for name_id in name_ids if bitmaps[bitmap_ids[name_id]] & mask]
+
+    def filter_ids(self, name_ids, mask):
+        # `filter` returning the ids
+        if mask is None:
+            return list(name_ids)
+        bitmaps, bitmap_ids = self.bitmaps, self.bitmap_ids
+        return [name_id for name_id in name_ids if bitmaps[bitmap_ids[name_id]] & mask]
+
+
+def _postings_by_key(keys_to_name_ids):
+    # Sorted keys of `keys_to_name_ids` and the name ids of every key
+    keys = sorted(keys_to_name_ids)
+    return StringTable.from_strings(keys), Postings.from_lists(keys_to_name_ids[key] for key in keys)
+
+
+class Trie(object):
+    # Nodes are numbered in preorder over the sorted keys: the first child of node `n` is `n + 1`,
+    # its subtree ends before `ends[n]`, and `labels[n]` is the character on the edge into `n`.
+    # Node 0 is the root. `bitmaps[bitmap_ids[n]]` is the union of datasource bitmaps of the keys
+    # under `n`, and `bitmaps[keys_bitmap_ids[k]]` is the datasource bitmap of key `k`.
+    __slots__ = ('keys', 'probes', 'visited', 'bitmaps', '_bitmap_ids', 'keys_bitmap_ids', 'labels', 'ends',
+                 'terminals', 'bitmap_ids')
+
+    def __init__(self, keys, keys_bitmaps):
+        self.keys = keys
+        self.probes = 0
+        self.visited = 0
+
+        self.bitmaps = []
+        self._bitmap_ids = {}
+        self.keys_bitmap_ids = array('i', [self._bitmap_id(bitmap) for bitmap in keys_bitmaps])
+
+        labels = ['\0']
+        self.ends = array('i', [0])
+        self.terminals = array('i', [-1])
+        self.bitmap_ids = array('i', [0])
+        path = [0]
+        path_bitmaps = [0]
+        previous_key = ''
+        for idx, key in enumerate(keys):
+            common = 0
+            while common < min(len(key), len(previous_key)) and key[common] == previous_key[common]:
+                common += 1
+            self._close(path, path_bitmaps, common + 1, len(labels))
+            for c in key[common:]:
+                path.append(len(labels))
+                path_bitmaps.append(0)
+                labels.append(c)
+                self.ends.append(0)
+                self.terminals.append(-1)
+                self.bitmap_ids.append(0)
+            self.terminals[path[-1]] = idx
+            path_bitmaps[-1] |= keys_bitmaps[idx]
+            previous_key = key
+        self._close(path, path_bitmaps, 0, len(labels))
+        self.labels = ''.join(labels)
+        del self._bitmap_ids
+
+    def _bitmap_id(self, bitmap):
+        if bitmap not in self._bitmap_ids:
+            self._bitmap_ids[bitmap] = len(self.bitmaps)
+            self.bitmaps.append(bitmap)
+        return self._bitmap_ids[bitmap]
+
+    def _close(self, path, path_bitmaps, depth, end):
+        # Completes the subtrees of the nodes on `path` deeper than `depth`
+        while len(path) > depth:
+            node = path.pop()
+            bitmap = path_bitmaps.pop()
+            self.ends[node] = end
+            self.bitmap_ids[node] = self._bitmap_id(bitmap)
+            if path_bitmaps:
+                path_bitmaps[-1] |= bitmap
+
+    def find_all(self, lev, mask=None):
+        # Keys accepted by the automaton `lev`. With a datasource `mask`, subtrees and keys
+        # without any of its datasources are skipped.
+        labels, ends, terminals = self.labels, self.ends, self.terminals
+        bitmaps, bitmap_ids, keys_bitmap_ids = self.bitmaps, self.bitmap_ids, self.keys_bitmap_ids
+        stack = [(1, ends[0], lev.start_state)]
+        while stack:
+            node, end, state = stack[-1]
+            if node >= end:
+                stack.pop()
+                continue
+            stack[-1] = (ends[node], end, state)
+
+            if mask is not None and not bitmaps[bitmap_ids[node]] & mask:
+                continue
+            self.probes += 1
+            node_state = lev.next_state(state, labels[node])
+            if node_state is None:
+                continue
+            self.visited += 1
+            key_idx = terminals[node]
+            if key_idx >= 0 and (mask is None or bitmaps[keys_bitmap_ids[key_idx]] & mask) and \
+                    lev.is_final(node_state):
+                yield self.keys[key_idx]
+            if node + 1 < ends[node]:
+                stack.append((node + 1, ends[node], node_state))
+
+    def find_best(self, lev, mask=None):
+        # `(distance, key)` of the keys accepted by the automaton `lev`, the closest first.
+        # Subtrees are walked by increasing `lev.min_distance` of their state, which never
+        # decreases down the trie and never exceeds `lev.max_edits`, so a key is yielded once no
+        # subtree left can have a closer key.
+        labels, ends, terminals = self.labels, self.ends, self.terminals
+        bitmaps, bitmap_ids, keys_bitmap_ids = self.bitmaps, self.bitmap_ids, self.keys_bitmap_ids
+        next_state, min_distance, max_edits = lev.next_state, lev.min_distance, lev.max_edits
+        # Subtrees and keys left for the larger distances
+        deferred = {}
+        found = {}
+        bound = min_distance(lev.start_state)
+        stack = [(1, ends[0], lev.start_state)]
+        while True:
+            for key in found.pop(bound, ()):
+                yield bound, key
+            while stack:
+                node, end, state = stack[-1]
+                if node >= end:
+                    stack.pop()
+                    continue
+                stack[-1] = (ends[node], end, state)
+
+                if mask is not None and not bitmaps[bitmap_ids[node]] & mask:
+                    continue
+                self.probes += 1
+                node_state = next_state(state, labels[node])
+                if node_state is None:
+                    continue
+                self.visited += 1
+                key_idx = terminals[node]
+                if key_idx >= 0 and (mask is None or bitmaps[keys_bitmap_ids[key_idx]] & mask) and \
+                        lev.is_final(node_state):
+                    distance = lev.distance(node_state)
+                    if distance == bound:
+                        yield distance, self.keys[key_idx]
+                    else:
+                        found.setdefault(distance, []).append(self.keys[key_idx])
+                if node + 1 < ends[node]:
+                    node_bound = bound if bound == max_edits else min_distance(node_state)
+                    if node_bound == bound:
+                        stack.append((node + 1, ends[node], node_state))
+                    else:
+                        deferred.setdefault(node_bound, []).append((node + 1, ends[node], node_state))
+            if not deferred and not found:
+                return
+            bound = min(list(deferred) + list(found))
+            stack = deferred.pop(bound, [])
+
+
+class TaggedTrie(Trie):
+    # `Trie` of the stem keys and the verbatim keys together, walked with the automata of both
+    # forms of a query at once. `stem_bitmap_ids[k]` is the bitmap id of key `k` as a stem key,
+    # -1 when it is not one, and `verbatim_bitmap_ids[k]` the same as a verbatim key. `tags[n]`
+    # has bit 1 when there are stem keys under node `n` and bit 2 when there are verbatim keys.
+    __slots__ = ('stem_bitmap_ids', 'verbatim_bitmap_ids', 'tags')
+
+    def __init__(self, stem_trie, verbatim_trie):
+        # Merge of the sorted keys of both tries
+        keys, stem_bitmaps, verbatim_bitmaps = [], [], []
+        stem_keys, verbatim_keys = iter(stem_trie.keys), iter(verbatim_trie.keys)
+        stem_idx, verbatim_idx = 0, 0
+        stem_key, verbatim_key = next(stem_keys, None), next(verbatim_keys, None)
+        while stem_key is not None or verbatim_key is not None:
+            key = min(key for key in (stem_key, verbatim_key) if key is not None)
+            stem_bitmap, verbatim_bitmap = None, None
+            if key == stem_key:
+                stem_bitmap = stem_trie.bitmaps[stem_trie.keys_bitmap_ids[stem_idx]]
+                stem_idx += 1
+                stem_key = next(stem_keys, None)
+            if key == verbatim_key:
+                verbatim_bitmap = verbatim_trie.bitmaps[verbatim_trie.keys_bitmap_ids[verbatim_idx]]
+                verbatim_idx += 1
+                verbatim_key = next(verbatim_keys, None)
+            keys.append(key)
+            stem_bitmaps.append(stem_bitmap)
+            verbatim_bitmaps.append(verbatim_bitmap)
+
+        Trie.__init__(self, StringTable.from_strings(keys),
+                      [(stem_bitmap or 0) | (verbatim_bitmap or 0)
+                       for stem_bitmap, verbatim_bitmap in zip(stem_bitmaps, verbatim_bitmaps)])
+        bitmap_ids = dict((bitmap, bitmap_id) for bitmap_id, bitmap in enumerate(self.bitmaps))
+        for bitmap in stem_bitmaps + verbatim_bitmaps:
+            if bitmap is not None and bitmap not in bitmap_ids:
+                bitmap_ids[bitmap] = len(self.bitmaps)
+                self.bitmaps.append(bitmap)
+        self.stem_bitmap_ids = array('i', [bitmap_ids[bitmap] if bitmap is not None else -1
+                                           for bitmap in stem_bitmaps])
+        self.verbatim_bitmap_ids = array('i', [bitmap_ids[bitmap] if bitmap is not None else -1
+                                               for bitmap in verbatim_bitmaps])
+
+        # Children come after their parent in preorder, so a reverse pass sees them first
+        ends, terminals = self.ends, self.terminals
+        self.tags = array('B', [0] * len(ends))
+        for node in range(len(ends) - 1, -1, -1):
+            key_idx = terminals[node]
+            tag = 0
+            if key_idx >= 0:
+                tag = (1 if stem_bitmaps[key_idx] is not None else 0) | \
+                      (2 if verbatim_bitmaps[key_idx] is not None else 0)
+            child = node + 1
+            while child < ends[node]:
+                tag |= self.tags[child]
+                child = ends[child]
+            self.tags[node] = tag
+
+    def find_all_tagged(self, stem_lev, verbatim_lev, mask=None, accept_stem=None):
+        # Stem keys accepted by `stem_lev` and verbatim keys accepted by `verbatim_lev`, in one
+        # walk, either automaton may be None. Stem keys must also pass `accept_stem`. Once one
+        # does, the verbatim keys would not be used, so their search stops and None is returned
+        # for them. The term of `stem_lev` is looked up first: when it is a stem key, the
+        # verbatim keys are not searched at all. The transitions of a `LevenshteinDFA` state only
+        # depend on the `table.width` term characters from its base, so while both terms agree on
+        # them, equal states step once for both automata.
+        labels, ends, terminals, tags = self.labels, self.ends, self.terminals, self.tags
+        bitmaps, bitmap_ids = self.bitmaps, self.bitmap_ids
+        stem_bitmap_ids, verbatim_bitmap_ids = self.stem_bitmap_ids, self.verbatim_bitmap_ids
+        stem_next = stem_lev.next_state if stem_lev is not None else None
+        verbatim_next = verbatim_lev.next_state if verbatim_lev is not None else None
+        stem_keys, verbatim_keys = [], []
+        found_stem = False
+        # Largest base of the states stepped once for both automata
+        shared = -1
+        if isinstance(stem_lev, LevenshteinDFA) and isinstance(verbatim_lev, LevenshteinDFA) and \
+                stem_lev.table is verbatim_lev.table:
+            common = 0
+            for stem_char, verbatim_char in zip(stem_lev.term, verbatim_lev.term):
+                if stem_char != verbatim_char:
+                    break
+                common += 1
+            shared = common - stem_lev.table.width
+        if stem_lev is not None and verbatim_lev is not None:
+            key_idx = self.keys.index(stem_lev.term)
+            found_stem = key_idx >= 0 and stem_bitmap_ids[key_idx] >= 0 and \
+                (mask is None or bitmaps[stem_bitmap_ids[key_idx]] & mask) and \
+                (accept_stem is None or accept_stem(stem_lev.term))
+        stack = [(1, ends[0], stem_lev.start_state if stem_lev is not None else None,
+                  verbatim_lev.start_state if verbatim_lev is not None else None)]
+        while stack:
+            node, end, stem_state, verbatim_state = stack[-1]
+            if node >= end:
+                stack.pop()
+                continue
+            stack[-1] = (ends[node], end, stem_state, verbatim_state)
+
+            if mask is not None and not bitmaps[bitmap_ids[node]] & mask:
+                continue
+            self.probes += 1
+            label = labels[node]
+            tag = tags[node]
+            if stem_state is not None and tag & 1:
+                next_stem_state = stem_next(stem_state, label)
+            else:
+                next_stem_state = None
+            if verbatim_state is not None and tag & 2 and not found_stem:
+                if shared >= 0 and tag & 1 and verbatim_state == stem_state and stem_state[0] <= shared:
+                    verbatim_state = next_stem_state
+                else:
+                    verbatim_state = verbatim_next(verbatim_state, label)
+            else:
+                verbatim_state = None
+            stem_state = next_stem_state
+            if stem_state is None and verbatim_state is None:
+                continue
+            self.visited += 1
+            key_idx = terminals[node]
+            if key_idx >= 0:
+                bitmap_id = stem_bitmap_ids[key_idx]
+                if stem_state is not None and bitmap_id >= 0 and (mask is None or bitmaps[bitmap_id] & mask) and \
+                        stem_lev.is_final(stem_state):
+                    key = self.keys[key_idx]
+                    if accept_stem is None or accept_stem(key):
+                        stem_keys.append(key)
+                        found_stem = True
+                        verbatim_state = None
+                bitmap_id = verbatim_bitmap_ids[key_idx]
+                if verbatim_state is not None and bitmap_id >= 0 and (mask is None or bitmaps[bitmap_id] & mask) and \
+                        verbatim_lev.is_final(verbatim_state):
+                    verbatim_keys.append(self.keys[key_idx])
+            if node + 1 < ends[node]:
+                stack.append((node + 1, ends[node], stem_state, verbatim_state))
+        return stem_keys, None if found_stem else verbatim_keys
+
+
+def _deletes(word, max_distance):
+    # `word` and the strings obtained by deleting up to `max_distance` of its characters
+    deletes = set([word])
+    edge = deletes
+    for _ in range(max_distance):
+        edge = set(w[:i] + w[i + 1:] for w in edge for i in range(len(w)))
+        deletes |= edge
+    return deletes
+
+
+class SymmetricDeleteIndex(object):
+    # Keys of a `Trie` by the deletions of up to `max_distance` characters of their first
+    # `prefix_length` characters (all of them when None). The prefixes of two strings within
+    # `max_distance` edits share a deletion, so the keys matching a query are among the keys
+    # under the deletions of its prefix: they are checked with `_bounded_levenshtein_many`, and
+    # with the automaton when it restricts the matches further. Same interface and results as
+    # the walk of the trie, as long as `max_distance` is at least `max_edits` of the automata.
+    def __init__(self, trie, max_distance=2, prefix_length=7):
+        self.trie = trie
+        self.keys = trie.keys
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.probes = 0
+        self.visited = 0
+        self.deletes = {}
+        for idx, key in enumerate(trie.keys):
+            for delete in _deletes(key[:prefix_length], max_distance):
+                if delete in self.deletes:
+                    self.deletes[delete].append(idx)
+                else:
+                    self.deletes[delete] = [idx]
+
+    def _matches(self, lev, mask):
+        # `(distance, key_idx)` of the keys accepted by `lev`, by key
+        word = lev.term
+        max_edits = min(self.max_distance, lev.max_edits)
+        keys_ids = set()
+        for delete in _deletes(word[:self.prefix_length], max_edits):
+            self.probes += 1
+            keys_ids.update(self.deletes.get(delete, ()))
+        keys_ids = sorted(keys_ids)
+        if mask is not None:
+            bitmaps, keys_bitmap_ids = self.trie.bitmaps, self.trie.keys_bitmap_ids
+            keys_ids = [key_idx for key_idx in keys_ids if bitmaps[keys_bitmap_ids[key_idx]] & mask]
+        self.visited += len(keys_ids)
+        keys = [self.keys[key_idx] for key_idx in keys_ids]
+        distances = _bounded_levenshtein_many(word, keys, max_edits)
+        plain = isinstance(lev, LevenshteinDFA)
+        return [
+            (distance, key)
+            for distance, key in zip(distances, keys)
+            if distance <= max_edits and (plain or _accepts(lev, key))
+        ]
 
+    def find_all(self, lev, mask=None):
+        for _, key in self._matches(lev, mask):
+            yield key
 
-def _levenshtein(s1, s2):
-    if len(s1) < len(s2):
-        return _levenshtein(s2, s1)
-    if not s1:
-        return len(s2)
+    def find_best(self, lev, mask=None):
+        # Stable sort: keys at the same distance stay in key order
+        for distance, key in sorted(self._matches(lev, mask), key=lambda match: match[0]):
+            yield distance, key
 
-    previous_row = xrange(len(s2) + 1)
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = \
-                previous_row[j + 1] + 1  # j+1 instead of j since previous_row and current_row are one character longer
-            deletions = current_row[j] + 1  # than s2
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
 
-    return previous_row[-1]
+def _accepts(lev, word):
+    state = lev.start_state
+    for c in word:
+        state = lev.next_state(state, c)
+        if state is None:
+            return False
+    return lev.is_final(state)
+
+
+class SearchEngine(object):
+    # Finds the keys of the stem and verbatim indexes matching a query automaton. Engines define
+    # `index(trie)`, returning the object searched, with the `find_all`, `find_best`, `probes` and
+    # `visited` of a `Trie`.
+    name = None
+
+    def options(self):
+        return {}
+
+
+class AutomatonEngine(SearchEngine):
+    # Walks the trie guided by the automaton
+    name = 'automaton'
+
+    def index(self, trie):
+        return trie
+
+
+class SymmetricDeleteEngine(SearchEngine):
+    # Looks the candidates up in a `SymmetricDeleteIndex`. A smaller `max_distance` or
+    # `prefix_length` makes the index smaller and the candidates more numerous; below the 2 edits
+    # of the automata, the matches further than `max_distance` are lost.
+    name = 'symmetric_delete'
+
+    def __init__(self, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+
+    def index(self, trie):
+        return SymmetricDeleteIndex(trie, self.max_distance, self.prefix_length)
+
+    def options(self):
+        return {'max_distance': self.max_distance, 'prefix_length': self.prefix_length}
+
+
+AUTOMATON_ENGINE = AutomatonEngine()
+ENGINES = {'automaton': AutomatonEngine, 'symmetric_delete': SymmetricDeleteEngine}
+
+
+def new_engine(name, **options):
+    # `SearchEngine` called `name` ('automaton' or 'symmetric_delete') with `options`
+    if name not in ENGINES:
+        raise ValueError('unknown engine %r' % name)
+    return ENGINES[name](**options)
+
+
+class QGramFilter(object):
+    # Bloom filter of the q-grams of keys padded with `q - 1` '\0' on both sides. An edit changes at
+    # most `q` of the `len(word) + q - 1` q-grams of a padded word, so a word with fewer than
+    # `len(word) + q - 1 - q * max_edits` q-grams in the filter is within `max_edits` edits of no
+    # key. False positives of the filter only let more words through.
+    __slots__ = ('bits', 'q', 'max_edits', 'hashes')
+
+    def __init__(self, bits, q=3, max_edits=2, hashes=3):
+        self.bits = bits
+        self.q = q
+        self.max_edits = max_edits
+        self.hashes = hashes
+
+    @classmethod
+    def from_keys(cls, keys, q=3, max_edits=2, hashes=3, bits_per_gram=10):
+        grams = set()
+        for key in keys:
+            grams.update(_qgrams(key, q))
+        bits = bytearray(max(8, len(grams) * bits_per_gram // 8))
+        gram_filter = cls(bits, q, max_edits, hashes)
+        for gram in grams:
+            for position in gram_filter._positions(gram):
+                bits[position >> 3] |= 1 << (position & 7)
+        return gram_filter
+
+    def _positions(self, gram):
+        data = gram.encode('utf-8')
+        size = len(self.bits) * 8
+        first = zlib.crc32(data) & 0xffffffff
+        second = zlib.crc32(data, 0x5bd1e995) & 0xffffffff
+        return [(first + i * second) % size for i in range(self.hashes)]
+
+    def __contains__(self, gram):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(gram))
+
+    def may_match(self, word):
+        # False when no key can be within `max_edits` edits of `word`
+        grams = _qgrams(word, self.q)
+        needed = len(grams) - self.q * self.max_edits
+        if needed <= 0:
+            return True
+        missing = len(grams) - needed
+        for gram in grams:
+            if gram in self:
+                needed -= 1
+                if not needed:
+                    return True
+            else:
+                missing -= 1
+                if missing < 0:
+                    return False
+        return False
+
+
+def _qgrams(word, q):
+    padded = '\0' * (q - 1) + word + '\0' * (q - 1)
+    return [padded[i:i + q] for i in range(len(word) + q - 1)]
+
+
+def _bounded_levenshtein_many(word, candidates, max_edits):
+    # Levenshtein distances from `word` to every candidate, capped at `max_edits + 1`. This is
+    # the bit-parallel algorithm of Myers in Hyyro's formulation for global edit distance: a
+    # column of the DP matrix is kept as vertical delta bit-vectors over the characters of `word`,
+    # and a candidate is abandoned as soon as its distance can not get back to `max_edits`.
+    word_len = len(word)
+    full = (1 << word_len) - 1
+    last = 1 << (word_len - 1) if word_len else 0
+    peq = {}
+    for i, c in enumerate(word):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    distances = []
+    for candidate in candidates:
+        candidate_len = len(candidate)
+        if abs(candidate_len - word_len) > max_edits:
+            distances.append(max_edits + 1)
+            continue
+        if not word_len:
+            distances.append(candidate_len)
+            continue
+
+        pv, mv, score = full, 0, word_len
+        for j, c in enumerate(candidate):
+            eq = peq.get(c, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & full)
+            mh = pv & xh
+            if ph & last:
+                score += 1
+            elif mh & last:
+                score -= 1
+            if score - (candidate_len - j - 1) > max_edits:
+                score = max_edits + 1
+                break
+            ph = ((ph << 1) | 1) & full
+            mh = (mh << 1) & full
+            pv = mh | (~(xv | ph) & full)
+            mv = ph & xv
+        distances.append(min(score, max_edits + 1))
+    return distances
+
+
+def _bounded_levenshtein(s1, s2, max_edits):
+    return _bounded_levenshtein_many(s1, [s2], max_edits)[0]
 
 
 def _matching_threshold_helper(word_input, word_candidate, space_edits):
-    print '_matching_threshold_helper> word_input:', word_input, \
-          '| word_candidate:', word_candidate, \
-          '| space_edits:', space_edits
     assert word_input.count(' ') == word_candidate.count(' ')
 
     word_input_parts = word_input.split(' ')
     word_candidate_parts = word_candidate.split(' ')
 
     for idx in range(len(word_input_parts)):
-        word_input_part_len = len(word_input_parts[idx])
-        if word_input_part_len < 6:
-            allowed_edits = 0
-        elif word_input_part_len < 11:
-            allowed_edits = 1
-        else:
-            allowed_edits = 2
+        allowed_edits = _allowed_edits(len(word_input_parts[idx]))
 
-        actual_edits = _levenshtein(word_input_parts[idx], word_candidate_parts[idx])
-        print '_matching_threshold_helper_iter>', word_input_parts[idx], '|', word_candidate_parts[idx], \
-              '||', allowed_edits, '-', actual_edits
+        actual_edits = _bounded_levenshtein(word_input_parts[idx], word_candidate_parts[idx],
+                                            max(allowed_edits - space_edits[idx], 0))
         if actual_edits + space_edits[idx] > allowed_edits:
             return False
 
     return True
 
 
-def _matching_threshold(word_input, word_candidate):
+def _matching_alignment(word_input, word_candidate):
+    # Finds how the parts of `word_candidate` align with the parts of `word_input` so that the
+    # candidate passes the matching threshold. When the words have different counts of spaces, the
+    # parts of the word with more spaces are glued into consecutive groups, one per part of the
+    # other word, and every removed space costs an edit. Returns the list of aligned
+    # `(word_input_part, word_candidate_part, space_edits)`, or None when nothing passes.
     word_input_spaces = word_input.count(' ')
     word_candidate_spaces = word_candidate.count(' ')
 
     if word_input_spaces == word_candidate_spaces:
         space_edits = [0] * (word_input_spaces + 1)
-        return _matching_threshold_helper(word_input, word_candidate, space_edits)
-    else:
-        word_long, word_short, word_long_spaces, word_short_spaces = \
-            (word_input, word_candidate, word_input_spaces, word_candidate_spaces) \
-            if word_input_spaces > word_candidate_spaces \
-            else (word_candidate, word_input, word_candidate_spaces, word_input_spaces)
-
-        # todo: when words are glued, the first one should not be stemed
-        # i.e. all the words that are glued to the first one should be verbatim
-        # eury tellina ~> `eurytellina`, but not `eurytellin`
-        word_long_parts = word_long.split(' ')
-        for comb in combinations(range(word_long_spaces), word_short_spaces):
-            word_long_idx = 0
-            word_long_new = ''
-            space_edits = [-1] * (word_short_spaces + 1)
-            for i, c in enumerate(comb):
-                while word_long_idx <= c:
-                    word_long_new += word_long_parts[word_long_idx]
-                    space_edits[i] += 1
-                    word_long_idx += 1
-                word_long_new += ' '
-            word_long_new += ''.join(word_long_parts[word_long_idx:])
-            space_edits[-1] += len(word_long_parts[word_long_idx:])
-
-            word_input_new, word_candidate_new = \
-                (word_long_new, word_short) \
-                if word_input_spaces > word_candidate_spaces \
-                else (word_short, word_long_new)
-
-            if _matching_threshold_helper(word_input_new, word_candidate_new, space_edits):
-                return True
-
-    return False
-
-
-def _find_all_matches(lev, lookup_func, lookup_ds):
-    match = lev.next_valid_string(u'\0')
-    while match:
-        nxt = lookup_func(match)
-        if not nxt:
+        if not _matching_threshold_helper(word_input, word_candidate, space_edits):
+            return None
+        return list(zip(word_input.split(' '), word_candidate.split(' '), space_edits))
+
+    input_is_long = word_input_spaces > word_candidate_spaces
+    word_long, word_short = (word_input, word_candidate) if input_is_long else (word_candidate, word_input)
+
+    # todo: when words are glued, the first one should not be stemed
+    # i.e. all the words that are glued to the first one should be verbatim
+    # eury tellina ~> `eurytellina`, but not `eurytellin`
+    word_long_parts = word_long.split(' ')
+    word_short_parts = word_short.split(' ')
+    groups_count = len(word_short_parts)
+    segments = {}
+
+    def segment_passes(short_idx, long_start, long_end):
+        # Whether long parts `long_start..long_end` glued together match the short part `short_idx`
+        key = (short_idx, long_start, long_end)
+        if key not in segments:
+            word_long_glued = ''.join(word_long_parts[long_start:long_end + 1])
+            word_short_part = word_short_parts[short_idx]
+            word_input_part = word_long_glued if input_is_long else word_short_part
+            allowed_edits = _allowed_edits(len(word_input_part)) - (long_end - long_start)
+            segments[key] = allowed_edits >= 0 and \
+                _bounded_levenshtein(word_long_glued, word_short_part, allowed_edits) <= allowed_edits
+        return segments[key]
+
+    # group_starts[j][t]: the start of the group of long parts ending at `t` that is aligned with
+    # the short part `j`, given that the short parts before `j` align with long parts before it
+    group_starts = [{} for _ in range(groups_count)]
+    for short_idx in range(groups_count):
+        # Every later short part needs at least one long part
+        last_end = len(word_long_parts) - groups_count + short_idx
+        for long_end in range(short_idx, last_end + 1):
+            first_start = 0 if short_idx == 0 else short_idx
+            last_start = 0 if short_idx == 0 else long_end
+            for long_start in range(first_start, last_start + 1):
+                if short_idx > 0 and long_start - 1 not in group_starts[short_idx - 1]:
+                    continue
+                if segment_passes(short_idx, long_start, long_end):
+                    group_starts[short_idx][long_end] = long_start
+                    break
+
+    long_end = len(word_long_parts) - 1
+    if long_end not in group_starts[-1]:
+        return None
+    alignment = []
+    for short_idx in reversed(range(groups_count)):
+        long_start = group_starts[short_idx][long_end]
+        word_long_glued = ''.join(word_long_parts[long_start:long_end + 1])
+        word_short_part = word_short_parts[short_idx]
+        alignment.append((word_long_glued, word_short_part, long_end - long_start) if input_is_long
+                         else (word_short_part, word_long_glued, long_end - long_start))
+        long_end = long_start - 1
+    alignment.reverse()
+    return alignment
+
+
+def _matching_threshold(word_input, word_candidate):
+    return _matching_alignment(word_input, word_candidate) is not None
+
+
+class LRUCache(object):
+    # Mapping of at most `capacity` entries that evicts the least recently used entry first
+    __slots__ = ('capacity', 'entries', 'hits', 'misses', 'evictions')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
             return
-        if match == nxt:
-            if lookup_ds(match):
-                yield match
-            nxt = nxt + u'\0'
-        match = lev.next_valid_string(nxt)
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
 
+    def clear(self):
+        self.entries.clear()
 
-class MatcherByStem:
-    def __init__(self, words_to_datasources):
-        print("Constructing MatcherByStem")
+    def stats(self):
+        return {'size': len(self.entries), 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
-        self.word_stemmized_to_words = {}
-        self.words_to_datasources = words_to_datasources
 
-        for idx, (word, data_sources) in enumerate(words_to_datasources.iteritems()):
-            if idx > 0 and idx % 100000 == 0:
-                print(idx)
+_timer = getattr(time, 'perf_counter', time.time)
 
-            word_stemmized = self.transform(word)
-            if word_stemmized not in self.word_stemmized_to_words:
-                self.word_stemmized_to_words[word_stemmized] = set()
-            self.word_stemmized_to_words[word_stemmized].add(word)
 
-        word_stemmized = list(self.word_stemmized_to_words.keys())
-        word_stemmized.sort()
-        self.bisect_by_word_stems = Matcher(word_stemmized)
+class Instrumentation(object):
+    # Receives the stages of every query of a `Finder`. This base class records nothing, see
+    # `QueryStats`. Stages are 'normalization', 'exact', 'transform', 'gram_filter', 'automaton',
+    # 'walk' (includes the 'threshold' checks), 'lookup' and 'filter', branches are 'genus_only',
+    # 'by_letter', 'stem' and 'verbatim'. The tiers ahead of the fuzzy search count
+    # 'exact_hits'/'exact_misses' and 'gram_filter_passes'/'gram_filter_rejects'. Nested
+    # queries, as the epithet queries of `MatcherByLetter`, are recorded as part of the outer
+    # query.
+
+    def begin_query(self):
         pass
 
-    def match(self, word, data_sources):
-        word_stem = self.transform(word)
-        lev = levenshtein_automata(word_stem).to_dfa()
+    def end_query(self, results):
+        pass
 
-        def lookup_ds(word_stem_candidate):
-            if not _matching_threshold(word_stem, word_stem_candidate):
-                return False
+    def start(self):
+        return None
+
+    def stage(self, name, started):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def branch(self, name):
+        pass
 
-            if len(data_sources) == 0:
-                return True
 
-            s = set(
-                ds
-                for w in self.word_stemmized_to_words[word_stem_candidate]
-                for ds in self.words_to_datasources[w]
-            )
-            intersect = s.intersection(data_sources)
-            return len(intersect) > 0
+NULL_INSTRUMENTATION = Instrumentation()
 
-        res = list(_find_all_matches(lev, self.bisect_by_word_stems, lookup_ds))
+
+class QueryStats(Instrumentation):
+    # Aggregates the queries: the count and total seconds of every stage with a histogram of its
+    # seconds per query, totals of the counters and counts of the branches. `last_query` has the
+    # stages, counters and branches of the last complete query.
+    BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+    def __init__(self):
+        self.depth = 0
+        self.current = None
+        self.last_query = None
+        self.queries = 0
+        self.stages = {}
+        self.counters = {}
+        self.branches = {}
+
+    def begin_query(self):
+        if self.depth == 0:
+            self.current = {'started': _timer(), 'stages': {}, 'counters': {}, 'branches': []}
+        self.depth += 1
+
+    def end_query(self, results):
+        self.depth -= 1
+        if self.depth > 0:
+            return
+        query, self.current = self.current, None
+        query['stages']['query'] = _timer() - query.pop('started')
+        query['counters']['results'] = results
+        self.queries += 1
+        for name, seconds in query['stages'].items():
+            if name not in self.stages:
+                self.stages[name] = {'count': 0, 'total': 0.0, 'histogram': [0] * (len(self.BUCKETS) + 1)}
+            stage = self.stages[name]
+            stage['count'] += 1
+            stage['total'] += seconds
+            stage['histogram'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        for name, value in query['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name in query['branches']:
+            self.branches[name] = self.branches.get(name, 0) + 1
+        self.last_query = query
+
+    def start(self):
+        return _timer()
+
+    def stage(self, name, started):
+        if self.current is not None:
+            stages = self.current['stages']
+            stages[name] = stages.get(name, 0.0) + _timer() - started
+
+    def count(self, name, value=1):
+        if self.current is not None:
+            counters = self.current['counters']
+            counters[name] = counters.get(name, 0) + value
+
+    def branch(self, name):
+        if self.current is not None:
+            self.current['branches'].append(name)
+
+    def export(self):
+        # Aggregates as plain data. Histogram buckets are `[upper bound in seconds, queries]`, the
+        # last bound is None.
+        bounds = list(self.BUCKETS) + [None]
+        return {
+            'queries': self.queries,
+            'stages': dict((name, {'count': stage['count'], 'total': stage['total'],
+                                   'histogram': [list(bucket) for bucket in zip(bounds, stage['histogram'])]})
+                           for name, stage in self.stages.items()),
+            'counters': dict(self.counters),
+            'branches': dict(self.branches),
+        }
+
+
+def _matching_automata(term, part_budgets, cache=None):
+    lev = cache.get(term) if cache is not None else None
+    if lev is None:
+        lev = levenshtein_automata(term)
+        if part_budgets:
+            lev = ProductAutomaton(lev, PartBudgetAutomaton(term))
+        if cache is not None:
+            cache.put(term, lev)
+    return lev
+
+
+def _find_all_matches(lev, index, mask, lookup_ds):
+    for match in index.find_all(lev, mask):
+        if lookup_ds(match):
+            yield match
+
+
+def _find_best_matches(lev, index, mask, lookup_ds, limit):
+    # Up to `limit` (all when None) `(distance, key)` pairs passing `lookup_ds`, the closest
+    # first. The walk stops as soon as they are found.
+    res = []
+    for distance, match in index.find_best(lev, mask):
+        if lookup_ds(match):
+            res.append((distance, match))
+            if limit is not None and len(res) >= limit:
+                break
+    return res
+
+
+# Names between two progress reports of the matchers construction
+PROGRESS_STEP = 10000
+
+
+class _KeysMatcher(object):
+    # Base of the matchers searching the names by a transformed form in a `Trie`. Subclasses
+    # define `transform` and `_keys_to_name_ids`, and name the attributes of their trie and of the
+    # name ids by key with `TRIE_ATTRIBUTE` and `NAME_IDS_ATTRIBUTE`.
+    TRIE_ATTRIBUTE = None
+    NAME_IDS_ATTRIBUTE = None
+
+    def __init__(self, words_to_datasources, part_budgets=False, verify_threshold=False, names=None,
+                 automata_cache=None, progress=None, engine=None, gram_filter=False):
+        logger.info('Constructing %s', type(self).__name__)
+
+        self.engine = engine if engine is not None else AUTOMATON_ENGINE
+        self.part_budgets = part_budgets
+        self.verify_threshold = verify_threshold
+        self.names = names if names is not None else NameTable(words_to_datasources)
+        self.automata_cache = automata_cache
+        self.instrumentation = NULL_INSTRUMENTATION
+
+        keys, name_ids = _postings_by_key(self._keys_to_name_ids(progress))
+        trie = Trie(keys, [self.names.union(key_name_ids) for key_name_ids in name_ids])
+        setattr(self, self.TRIE_ATTRIBUTE, trie)
+        setattr(self, self.NAME_IDS_ATTRIBUTE, name_ids)
+        self.index = self.engine.index(trie)
+        self.gram_filter = QGramFilter.from_keys(trie.keys) if gram_filter else None
+
+    @property
+    def trie(self):
+        return getattr(self, self.TRIE_ATTRIBUTE)
+
+    def automaton(self, word):
+        # Transformed `word` and its automaton, None when the q-gram filter rules the word out
+        instrumentation = self.instrumentation
+        started = instrumentation.start()
+        word_transformed = self.transform(word)
+        instrumentation.stage('transform', started)
+        if self.gram_filter is not None:
+            started = instrumentation.start()
+            passed = self.gram_filter.may_match(word_transformed)
+            instrumentation.stage('gram_filter', started)
+            instrumentation.count('gram_filter_passes' if passed else 'gram_filter_rejects')
+            if not passed:
+                return word_transformed, None
+        started = instrumentation.start()
+        lev = _matching_automata(word_transformed, self.part_budgets, self.automata_cache)
+        instrumentation.stage('automaton', started)
+        return word_transformed, lev
+
+    def accepts(self, word_transformed, candidate):
+        # Whether a candidate accepted by the automaton of `word_transformed` is a match
+        if not self.part_budgets or self.verify_threshold:
+            instrumentation = self.instrumentation
+            started = instrumentation.start()
+            passed = _matching_threshold(word_transformed, candidate)
+            instrumentation.stage('threshold', started)
+            instrumentation.count('threshold_checks')
+            return passed
+        return True
+
+    def match(self, word, data_sources, limit=None, ranked=False):
+        # Transformed words matching `word`. When ranked or with `limit`, at most `limit`
+        # `(distance, transformed word)` pairs, the closest first.
+        instrumentation = self.instrumentation
+        word_transformed, lev = self.automaton(word)
+        if lev is None:
+            return []
+
+        def lookup_ds(candidate):
+            return self.accepts(word_transformed, candidate)
+
+        mask = self.names.mask(data_sources)
+        index = self.index
+        probes, visited = index.probes, index.visited
+        started = instrumentation.start()
+        if limit is None and not ranked:
+            res = list(_find_all_matches(lev, index, mask, lookup_ds))
+        else:
+            res = _find_best_matches(lev, index, mask, lookup_ds, limit)
+        instrumentation.stage('walk', started)
+        instrumentation.count('probes', index.probes - probes)
+        instrumentation.count('visited', index.visited - visited)
         return res
 
+    def lookup_ids(self, word_transformed):
+        idx = self.trie.keys.index(word_transformed)
+        return getattr(self, self.NAME_IDS_ATTRIBUTE)[idx] if idx >= 0 else []
+
+    def lookup(self, word_transformed):
+        return self.names.filter(self.lookup_ids(word_transformed), None)
+
+
+class MatcherByStem(_KeysMatcher):
+    TRIE_ATTRIBUTE = 'trie_by_word_stems'
+    NAME_IDS_ATTRIBUTE = 'word_stemmized_to_words'
+
+    def _keys_to_name_ids(self, progress):
+        word_stemmized_to_name_ids = {}
+        names = iter(self.names.names)
+        for start in range(0, len(self.names), PROGRESS_STEP):
+            if progress is not None:
+                progress(start, len(self.names))
+
+            words = list(itertools.islice(names, PROGRESS_STEP))
+            for name_id, word_stemmized in enumerate(self.transform_many(words), start):
+                if word_stemmized not in word_stemmized_to_name_ids:
+                    word_stemmized_to_name_ids[word_stemmized] = []
+                word_stemmized_to_name_ids[word_stemmized].append(name_id)
+        return word_stemmized_to_name_ids
+
     @staticmethod
     def __stemmize_word(word):
         word_parts = word.split(' ')
@@ -379,146 +1540,162 @@ class MatcherByStem:
         word_stemmized = MatcherByStem.__stemmize_word(word.lower())
         return word_stemmized
 
-    def lookup(self, word_transformed):
-        return self.word_stemmized_to_words.get(word_transformed, set())
+    @staticmethod
+    def transform_many(words):
+        # `transform` of every word of `words`, with their epithets stemmed in one batch
+        words_parts = [word.lower().split(' ') for word in words]
+        stems = iter(LatinStemmer.stemmize_many(word_part for word_parts in words_parts
+                                                for word_part in word_parts[1:]))
+        return [
+            word_parts[0] if len(word_parts) < 2 else
+            word_parts[0] + ' ' + ' '.join(next(stems).stem for _ in word_parts[1:])
+            for word_parts in words_parts
+        ]
 
 
-class MatcherByVerbatim:
-    def __init__(self, words_to_datasources):
-        print("Constructing MatcherByVerbatim")
+class MatcherByVerbatim(_KeysMatcher):
+    TRIE_ATTRIBUTE = 'trie_by_word_verbatims'
+    NAME_IDS_ATTRIBUTE = 'words_verbatims_to_words'
 
-        self.words_to_datasources = words_to_datasources
-        self.words_verbatims_to_words = {}
-
-        for idx, word in enumerate(words_to_datasources.keys()):
-            if idx > 0 and idx % 100000 == 0:
-                print(idx)
+    def _keys_to_name_ids(self, progress):
+        words_verbatims_to_name_ids = {}
+        for name_id, word in enumerate(self.names.names):
+            if progress is not None and name_id % PROGRESS_STEP == 0:
+                progress(name_id, len(self.names))
 
             word_verbatim = self.transform(word)
 
-            if word_verbatim not in self.words_verbatims_to_words:
-                self.words_verbatims_to_words[word_verbatim] = set()
-            self.words_verbatims_to_words[word_verbatim].add(word)
-
-        word_verbatims = list(self.words_verbatims_to_words.keys())
-        word_verbatims.sort()
-        self.bisect_by_word_verbatims = Matcher(word_verbatims)
-        pass
-
-    def match(self, word, data_sources):
-        word_verbatim = self.transform(word)
-        lev = levenshtein_automata(word_verbatim).to_dfa()
-
-        def lookup_ds(word_verbatim_candidate):
-            if not _matching_threshold(word_verbatim, word_verbatim_candidate):
-                return False
-
-            if len(data_sources) == 0:
-                return True
-
-            s = set(ds
-                    for w_orig in self.words_verbatims_to_words[word_verbatim_candidate]
-                    for ds in self.words_to_datasources[w_orig])
-            intersect = s.intersection(data_sources)
-            return len(intersect) > 0
-
-        res = list(_find_all_matches(lev, self.bisect_by_word_verbatims, lookup_ds))
-        return res
+            if word_verbatim not in words_verbatims_to_name_ids:
+                words_verbatims_to_name_ids[word_verbatim] = []
+            words_verbatims_to_name_ids[word_verbatim].append(name_id)
+        return words_verbatims_to_name_ids
 
     @staticmethod
     def transform(word):
         word_verbatim = word.lower().replace('j', 'i').replace('v', 'u')
         return word_verbatim
 
-    def lookup(self, word_transformed):
-        return self.words_verbatims_to_words.get(word_transformed, set())
-
 
-class MatcherByGenusOnly:
-    def __init__(self, words_to_datasources):
-        print("Constructing MatcherByGenusOnly")
+class MatcherByGenusOnly(object):
+    def __init__(self, words_to_datasources, names=None, progress=None):
+        logger.info('Constructing MatcherByGenusOnly')
 
-        self.words_to_datasources = words_to_datasources
-        self.words_genus_only_to_words = {}
+        self.names = names if names is not None else NameTable(words_to_datasources)
 
-        for idx, word in enumerate(words_to_datasources.keys()):
-            if idx > 0 and idx % 100000 == 0:
-                print(idx)
+        words_genus_only_to_name_ids = {}
+        for name_id, word in enumerate(self.names.names):
+            if progress is not None and name_id % PROGRESS_STEP == 0:
+                progress(name_id, len(self.names))
 
             word_transformed = self.transform(word)
             if ' ' in word_transformed:
                 continue
 
-            if word_transformed not in self.words_genus_only_to_words:
-                self.words_genus_only_to_words[word_transformed] = set()
-            self.words_genus_only_to_words[word_transformed].add(word)
+            if word_transformed not in words_genus_only_to_name_ids:
+                words_genus_only_to_name_ids[word_transformed] = []
+            words_genus_only_to_name_ids[word_transformed].append(name_id)
 
+        self.words_genus_only, self.words_genus_only_to_words = _postings_by_key(words_genus_only_to_name_ids)
         pass
 
     def match(self, word, data_sources):
         word_transformed = self.transform(word)
-        res = self.words_genus_only_to_words.get(word_transformed, set())
-        if data_sources:
-            res = [r for r in res
-                   if len(data_sources.intersection(self.words_to_datasources[r]))]
-        return res
+        return self.names.filter(self.lookup_ids(word_transformed), self.names.mask(data_sources))
 
     @staticmethod
     def transform(word):
         word_verbatim = word.lower().replace('j', 'i').replace('v', 'u')
         return word_verbatim
 
+    def lookup_ids(self, word_transformed):
+        idx = self.words_genus_only.index(word_transformed)
+        return self.words_genus_only_to_words[idx] if idx >= 0 else []
+
     def lookup(self, word_transformed):
-        res = self.words_genus_only_to_words.get(word_transformed, set())
-        return res
+        return self.names.filter(self.lookup_ids(word_transformed), None)
 
     @staticmethod
     def verify(word_cleaned):
         return ' ' not in word_cleaned
 
 
-class MatcherByLetter:
-    def __init__(self, words_to_datasources):
-        print "Constructing MatcherByLetter"
+class MatcherByLetter(object):
+    # Epithets of all the genera share one `Finder`. Its datasources are `(letter, data_source)`
+    # tags plus a `(letter, None)` tag for every letter, so the first letter is filtered in the
+    # index walk together with the datasources.
+    def __init__(self, words_to_datasources, part_budgets=False, verify_threshold=False, names=None,
+                 automata_cache_size=0, progress=None, engine=None, gram_filter=False, combined_search=False):
+        logger.info('Constructing MatcherByLetter')
 
-        self.words_to_datasources = words_to_datasources
-        self.letter_to_matching = {}
+        self.names = names if names is not None else NameTable(words_to_datasources)
+        self.letters = set()
+        words_rest_to_tags = {}
+        words_rest_to_name_ids = {}
 
-        for idx, word in enumerate(words_to_datasources.keys()):
-            if idx > 0 and idx % 100000 == 0:
-                print(idx)
+        for name_id, word in enumerate(self.names.names):
+            if progress is not None and name_id % PROGRESS_STEP == 0:
+                progress(name_id, len(self.names))
 
             letter, word_rest = self.transform(word)
-            if letter not in self.letter_to_matching:
-                self.letter_to_matching[letter] = {'words_to_datasources': {}, 'words_rest_to_words_full': {}}
+            self.letters.add(letter)
 
             if word_rest is not None:
-                self.letter_to_matching[letter]['words_to_datasources'][word_rest] = words_to_datasources[word]
-                if word_rest not in self.letter_to_matching[letter]['words_rest_to_words_full']:
-                    self.letter_to_matching[letter]['words_rest_to_words_full'][word_rest] = set()
-                self.letter_to_matching[letter]['words_rest_to_words_full'][word_rest].add(word)
-
-        for letter in self.letter_to_matching.keys():
-            print "Constructing MatcherByLetter | letter", letter
-            finder = Finder(self.letter_to_matching[letter]['words_to_datasources'],
-                            matcher_by_letter_context=True)
-            self.letter_to_matching[letter]['finder'] = finder
+                if word_rest not in words_rest_to_tags:
+                    words_rest_to_tags[word_rest] = set()
+                    words_rest_to_name_ids[word_rest] = []
+                tags = words_rest_to_tags[word_rest]
+                tags.add((letter, None))
+                tags.update((letter, data_source) for data_source in self.names.data_sources(name_id))
+                words_rest_to_name_ids[word_rest].append(name_id)
+
+        logger.info('Constructing MatcherByLetter | epithets')
+        # Results are cached by the `Finder` of the full names
+        self.finder = Finder(words_rest_to_tags, matcher_by_letter_context=True,
+                             part_budgets=part_budgets, verify_threshold=verify_threshold,
+                             cache_size=0, automata_cache_size=automata_cache_size, engine=engine,
+                             gram_filter=gram_filter, combined_search=combined_search)
+        # Ids of the full names by id of the epithet in `self.finder`
+        _, self.words_rest_to_words_full = _postings_by_key(words_rest_to_name_ids)
 
     def match(self, word, data_sources):
+        for res in self.routes(word, data_sources):
+            if res:
+                return res
+        return []
+
+    def routes(self, word, data_sources, limit=None, ranked=False):
+        # Full names matching the stem and then the verbatim of the epithets of `word`. When
+        # ranked or with `limit`, `Candidate`s of the names of the closest `limit` epithets, with
+        # the edit distances of the epithets.
         letter, word_rest = self.transform(word)
-        if letter not in self.letter_to_matching:
-            return []
-        matching = self.letter_to_matching[letter]
-        res = matching['finder'].find_all_matches(word_rest, data_sources)
-        res = [
-            word_full
-            for r in res
-            for word_full in matching['words_rest_to_words_full'][r]
-        ]
+        if letter not in self.letters:
+            yield []
+            yield []
+            return
         if data_sources:
-            res = [r for r in res
-                   if len(data_sources.intersection(self.words_to_datasources[r]))]
-        return res
+            tags = set((letter, data_source) for data_source in data_sources)
+        else:
+            tags = {(letter, None)}
+        mask = self.names.mask(data_sources)
+        for _, res in self.finder._routes(word_rest, tags, limit, ranked):
+            if limit is not None or ranked:
+                yield [
+                    _candidate(self.names, name_id, 'by_letter', data_sources, None,
+                               candidate.stem_edit_distance, candidate.verbatim_edit_distance)
+                    for candidate in res
+                    for name_id in self._full_name_ids([candidate.term], letter, mask)
+                ]
+            else:
+                yield self.names.filter(self._full_name_ids(res, letter, mask), None)
+
+    def _full_name_ids(self, words_rest, letter, mask):
+        name_ids = [
+            name_id
+            for r in words_rest
+            for name_id in self.words_rest_to_words_full[self.finder.names.name_id(r)]
+        ]
+        return [name_id for name_id in self.names.filter_ids(name_ids, mask)
+                if self.transform(self.names.name(name_id))[0] == letter]
 
     @staticmethod
     def transform(word):
@@ -535,75 +1712,1182 @@ class MatcherByLetter:
         return len(word_parts) > 0 and len(word_parts[0]) == 2 and word_parts[0].endswith('.')
 
 
-class Finder:
-    def __init__(self, words_to_datasources, matcher_by_letter_context=False):
-        self.words_to_datasources = words_to_datasources
-        self.matcher_by_stem = MatcherByStem(words_to_datasources)
-        self.matcher_by_verbatim = MatcherByVerbatim(words_to_datasources)
-        self.matcher_by_letter_context = matcher_by_letter_context
-        if not self.matcher_by_letter_context:
-            self.matcher_by_genus_only = MatcherByGenusOnly(words_to_datasources)
-            self.matcher_by_letter = MatcherByLetter(words_to_datasources)
+class Candidate(object):
+    # Name matching a query. `data_source_ids` are the datasources of the name among the queried
+    # ones (all of them for a query without datasources). The edit distances are taken from the
+    # automaton state that accepted the name: `stem_edit_distance` on the 'stem' branch and
+    # `verbatim_edit_distance` on the 'verbatim' one, the other is None. A 'genus_only' name
+    # matches verbatim, and a 'by_letter' name has the distances of its epithets.
+    __slots__ = ('term', 'stem', 'data_source_ids', 'stem_edit_distance', 'verbatim_edit_distance', 'branch')
 
-    def __pipeline(self, word, data_sources=set()):
-        word_cleaned = re.sub('\s+', ' ', word.strip()).lower()
-        print 'request: ', word_cleaned, '|', data_sources
+    def __init__(self, term, stem, data_source_ids, stem_edit_distance, verbatim_edit_distance, branch):
+        self.term = term
+        self.stem = stem
+        self.data_source_ids = data_source_ids
+        self.stem_edit_distance = stem_edit_distance
+        self.verbatim_edit_distance = verbatim_edit_distance
+        self.branch = branch
 
+    @property
+    def distance(self):
+        # Edit distance the candidate was found with
+        if self.stem_edit_distance is not None:
+            return self.stem_edit_distance
+        return self.verbatim_edit_distance
+
+    def __eq__(self, other):
+        return isinstance(other, Candidate) and all(getattr(self, slot) == getattr(other, slot)
+                                                    for slot in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Candidate(%s)' % ', '.join('%s=%r' % (slot, getattr(self, slot)) for slot in self.__slots__)
+
+
+def _candidate(names, name_id, branch, data_sources, stem, stem_edit_distance, verbatim_edit_distance):
+    # `Candidate` of name `name_id` of `names`, its stem is computed when None
+    term = names.name(name_id)
+    data_source_ids = names.data_sources(name_id)
+    if data_sources:
+        data_source_ids &= set(data_sources)
+    if stem is None:
+        stem = MatcherByStem.transform(term)
+    return Candidate(term, stem, frozenset(data_source_ids), stem_edit_distance, verbatim_edit_distance, branch)
+
+
+class IndexNotReady(RuntimeError):
+    # Raised by queries needing a matcher of a `Finder` that is still being built
+    pass
+
+
+def clean_word(word):
+    # Form of `word` the matchers work on: lower-cased with runs of spaces collapsed
+    return re.sub(r'\s+', ' ', _to_text(word).strip()).lower()
+
+
+class _Indexes(object):
+    # Names and matchers of a `Finder`. A merge publishes new `_Indexes` and never changes the
+    # ones queries may be reading, so they are freed once those queries are done.
+    __slots__ = ('names', 'matcher_by_genus_only', 'matcher_by_verbatim', 'matcher_by_stem', 'matcher_by_letter',
+                 'combined_trie')
+
+    def __init__(self, names):
+        self.names = names
+        self.matcher_by_genus_only = None
+        self.matcher_by_verbatim = None
+        self.matcher_by_stem = None
+        self.matcher_by_letter = None
+        self.combined_trie = None
+
+
+def _indexes_property(attribute):
+    # Attribute of the published `_Indexes` of a `Finder`. It is only set while the `Finder` is
+    # constructed, built or loaded.
+    def get(finder):
+        return getattr(finder._index[0], attribute)
+
+    def set(finder, value):
+        setattr(finder._index[0], attribute, value)
+
+    return property(get, set)
+
+
+class Finder(object):
+    # Names added, removed or with new datasources since the indexes were built go to a small
+    # delta `Finder`, and their stale entries in the indexes are hidden by tombstones. The delta
+    # is merged into new indexes once it grows past `MERGE_FACTOR * sqrt(names)`. The indexes,
+    # the delta and the tombstones are published together in `_index`, so queries always see a
+    # consistent state. The names and the matchers of a finder are the ones of its published
+    # indexes.
+    MERGE_FACTOR = 4
+    MERGE_MIN = 64
+    # Matchers in the order they are built, the fast and the most queried first
+    MATCHERS = ('genus_only', 'verbatim', 'stem', 'by_letter')
+    MATCHER_ATTRIBUTES = {'genus_only': 'matcher_by_genus_only', 'verbatim': 'matcher_by_verbatim',
+                          'stem': 'matcher_by_stem', 'by_letter': 'matcher_by_letter'}
+
+    names = _indexes_property('names')
+    matcher_by_genus_only = _indexes_property('matcher_by_genus_only')
+    matcher_by_verbatim = _indexes_property('matcher_by_verbatim')
+    matcher_by_stem = _indexes_property('matcher_by_stem')
+    matcher_by_letter = _indexes_property('matcher_by_letter')
+    combined_trie = _indexes_property('combined_trie')
+
+    def __init__(self, words_to_datasources, matcher_by_letter_context=False,
+                 part_budgets=False, verify_threshold=False, cache_size=10000, automata_cache_size=1000,
+                 instrumentation=None, build_workers=1, wait=True, progress=None, engine=None,
+                 exact_first=False, gram_filter=False, combined_search=False):
+        # part_budgets: enforce the per word part edit budgets while walking the index
+        # verify_threshold: re-check candidates with `_matching_threshold` (debugging aid)
+        # cache_size: results kept by cleaned word and datasources, 0 to disable
+        # automata_cache_size: automata kept by transformed word, 0 to disable
+        # instrumentation: `Instrumentation` receiving the stages of the queries, see `QueryStats`
+        # build_workers: processes building the matchers, None for one per core, 1 to build them here
+        # wait: return once every matcher is built, otherwise they are built in a background thread
+        #     and queries needing one that is not ready raise `IndexNotReady`, see `completed`
+        # progress: called with the matcher, the names processed and the names in total while building
+        # engine: `SearchEngine` of the stem and verbatim indexes, `AutomatonEngine` by default
+        # exact_first: answer with the names of the exact stem, or else verbatim, of a query when
+        #     there are any, without the fuzzy search
+        # gram_filter: skip the fuzzy search of the words a `QGramFilter` rules out
+        # combined_search: search the stem and the verbatim forms in one walk of a `TaggedTrie`
+        #     instead of one after the other, for the queries without a limit
+        self._init_caches(cache_size, automata_cache_size)
+        self.instrumentation = NULL_INSTRUMENTATION
+        self.engine = engine if engine is not None else AUTOMATON_ENGINE
+        self.exact_first = exact_first
+        self.gram_filter = gram_filter
+        self.combined_search = combined_search
+        self.part_budgets = part_budgets
+        self.verify_threshold = verify_threshold
+        self.build_workers = build_workers
+        self.matcher_by_letter_context = matcher_by_letter_context
+        self._init_index(NameTable(words_to_datasources))
+        if instrumentation is not None:
+            self.set_instrumentation(instrumentation)
+
+        matchers = ('verbatim', 'stem') if matcher_by_letter_context else self.MATCHERS
+        self._build = _FinderBuild(self, words_to_datasources, matchers, automata_cache_size, build_workers,
+                                   progress)
+        if wait:
+            self._build.run()
+        else:
+            self._build.start()
+
+    def _init_caches(self, cache_size, automata_cache_size):
+        # `generation` is bumped by `invalidate`, results computed in an older generation are not cached
+        self.generation = 0
+        self.results_cache = LRUCache(cache_size)
+        self.automata_cache = LRUCache(automata_cache_size) if automata_cache_size > 0 else None
+
+    def _init_index(self, names):
+        # `_index` is `(indexes, delta, tombstones, delta_names)`: the `_Indexes`, the `Finder` of
+        # the delta or None, the names hidden in the indexes and the datasources of the names of
+        # the delta. `_pending` has the delta names and tombstones of `updating`.
+        self._index = (_Indexes(names), None, frozenset(), {})
+        self._pending = None
+
+    def invalidate(self):
+        # Drops the cached results, to be called whenever the indexes change. Automata depend on
+        # the query only and are kept.
+        self.generation += 1
+        self.results_cache.clear()
+
+    def set_instrumentation(self, instrumentation):
+        self.instrumentation = instrumentation
+        # Matchers still being built get it when they are set
+        for attribute in ('matcher_by_stem', 'matcher_by_verbatim'):
+            matcher = getattr(self, attribute, None)
+            if matcher is not None:
+                matcher.instrumentation = instrumentation
+        matcher_by_letter = getattr(self, 'matcher_by_letter', None)
+        if matcher_by_letter is not None:
+            matcher_by_letter.finder.set_instrumentation(instrumentation)
+        delta = self._index[1]
+        if delta is not None:
+            delta.set_instrumentation(instrumentation)
+
+    def _new_matcher(self, matcher, words_to_datasources, automata_cache_size, progress=None):
+        if matcher == 'stem':
+            return MatcherByStem(words_to_datasources, self.part_budgets, self.verify_threshold, self.names,
+                                 self.automata_cache, progress, self.engine, self.gram_filter)
+        if matcher == 'verbatim':
+            return MatcherByVerbatim(words_to_datasources, self.part_budgets, self.verify_threshold, self.names,
+                                     self.automata_cache, progress, self.engine, self.gram_filter)
+        if matcher == 'genus_only':
+            return MatcherByGenusOnly(words_to_datasources, self.names, progress)
+        return MatcherByLetter(words_to_datasources, self.part_budgets, self.verify_threshold, self.names,
+                               automata_cache_size, progress, self.engine, self.gram_filter, self.combined_search)
+
+    def _set_matcher(self, matcher, value):
+        setattr(self, self.MATCHER_ATTRIBUTES[matcher], value)
+        self.set_instrumentation(self.instrumentation)
+        if self.combined_search and matcher in ('stem', 'verbatim'):
+            self._set_combined_trie()
+
+    def _set_combined_trie(self):
+        # Once both the stem and the verbatim matchers are there
+        stem = getattr(self, 'matcher_by_stem', None)
+        verbatim = getattr(self, 'matcher_by_verbatim', None)
+        if stem is not None and verbatim is not None:
+            self.combined_trie = TaggedTrie(stem.trie, verbatim.trie)
+
+    def is_ready(self, matcher=None):
+        # Whether `matcher` ('genus_only', 'verbatim', 'stem' or 'by_letter'), or all of them when
+        # None, is built
+        build = self._build
+        return build is None or build.is_ready(matcher)
+
+    def completed(self, timeout=None):
+        # Waits for all the matchers to be built: True when they are, False when `timeout` seconds
+        # passed first. Raises the error of a failed construction.
+        build = self._build
+        return build is None or build.wait(timeout)
+
+    def _require(self, matcher):
+        build = self._build
+        if build is not None and not build.is_ready(matcher):
+            raise IndexNotReady(matcher)
+
+    def cache_stats(self):
+        return {'results': self.results_cache.stats(),
+                'automata': self.automata_cache.stats() if self.automata_cache is not None else None}
+
+    @contextmanager
+    def updating(self):
+        # Groups the updates made in the block: queries see either none or all of them. Nothing is
+        # applied when the block raises.
+        if self._pending is not None:
+            yield self
+            return
+        _, _, tombstones, delta_names = self._index
+        self._pending = (dict(delta_names), set(tombstones))
+        try:
+            yield self
+        except BaseException:
+            self._pending = None
+            raise
+        delta_names, tombstones = self._pending
+        self._pending = None
+        self._publish(delta_names, tombstones)
+
+    def add_name(self, name, data_sources):
+        # Adds `name`, or replaces its datasources when it is already there
+        name = _to_text(name)
+        with self.updating():
+            delta_names, tombstones = self._pending
+            if self._index[0].names.name_id(name) >= 0:
+                tombstones.add(name)
+            delta_names[name] = frozenset(data_sources)
+
+    def remove_name(self, name):
+        name = _to_text(name)
+        with self.updating():
+            delta_names, tombstones = self._pending
+            if name in delta_names:
+                del delta_names[name]
+            elif name not in tombstones and self._index[0].names.name_id(name) >= 0:
+                tombstones.add(name)
+            else:
+                raise KeyError(name)
+
+    def update_datasources(self, name, data_sources):
+        name = _to_text(name)
+        with self.updating():
+            delta_names, tombstones = self._pending
+            if name not in delta_names and (name in tombstones or self._index[0].names.name_id(name) < 0):
+                raise KeyError(name)
+            self.add_name(name, data_sources)
+
+    def _build_finder(self, words_to_datasources, build_workers=1):
+        # Indexes or delta over `words_to_datasources` with the settings and caches of this finder
+        finder = Finder(words_to_datasources, self.matcher_by_letter_context, self.part_budgets,
+                        self.verify_threshold, cache_size=0, automata_cache_size=0,
+                        instrumentation=self.instrumentation, build_workers=build_workers, engine=self.engine,
+                        exact_first=self.exact_first, gram_filter=self.gram_filter,
+                        combined_search=self.combined_search)
+        finder.matcher_by_stem.automata_cache = self.automata_cache
+        finder.matcher_by_verbatim.automata_cache = self.automata_cache
+        return finder
+
+    def _words_to_datasources(self, indexes, tombstones, delta_names):
+        names = indexes.names
+        words_to_datasources = dict((name, names.data_sources(name_id)) for name_id, name in enumerate(names.names)
+                                    if name not in tombstones)
+        words_to_datasources.update(delta_names)
+        return words_to_datasources
+
+    def _publish(self, delta_names, tombstones):
+        indexes = self._index[0]
+        if len(delta_names) + len(tombstones) > max(self.MERGE_MIN, self.MERGE_FACTOR * len(indexes.names) ** 0.5):
+            # The matchers still being built would be set after the merge
+            self.completed()
+            merged = self._build_finder(self._words_to_datasources(indexes, tombstones, delta_names),
+                                        self.build_workers)
+            self._index = (merged._index[0], None, frozenset(), {})
+        else:
+            delta = self._build_finder(delta_names) if delta_names else None
+            self._index = (indexes, delta, frozenset(tombstones), delta_names)
+        self.invalidate()
+
+    def _routes(self, word_cleaned, data_sources, limit=None, ranked=False, indexes=None):
+        # Branch and names matching `word_cleaned` in `indexes`, the published ones of this finder
+        # by default, for each of the routes of its branch in order: a query is answered by the
+        # first route with any names. When ranked or with `limit`, the names are up to `limit`
+        # `Candidate`s, the closest first.
+        if indexes is None:
+            indexes = self._index[0]
+        names = indexes.names
+        instrumentation = self.instrumentation
+        ranked = ranked or limit is not None
         if not self.matcher_by_letter_context:
             if MatcherByGenusOnly.verify(word_cleaned):
-                matches_genus_only = self.matcher_by_genus_only.match(word_cleaned, data_sources)
-                print 'single word match', matches_genus_only
+                self._require('genus_only')
+                started = instrumentation.start()
+                matches_genus_only = indexes.matcher_by_genus_only.match(word_cleaned, data_sources)
+                instrumentation.stage('filter', started)
+                logger.debug('single word match %s', matches_genus_only)
+                started = instrumentation.start()
                 res = [
                     w
                     for match_genus_only in matches_genus_only
-                    for w in self.matcher_by_genus_only.lookup(match_genus_only)
+                    for w in indexes.matcher_by_genus_only.lookup(match_genus_only)
                 ]
-                print 'single word match (filtered)', res
-                return res
+                instrumentation.stage('lookup', started)
+                logger.debug('single word match (filtered) %s', res)
+                if ranked:
+                    res = [_candidate(names, names.name_id(name), 'genus_only', data_sources, None, None, 0)
+                           for name in res[:limit]]
+                yield 'genus_only', res
+                return
 
             if MatcherByLetter.verify(word_cleaned):
-                self.matcher_by_letter.transform(word_cleaned)
-
-                matches_by_letter = self.matcher_by_letter.match(word_cleaned, data_sources)
-                print 'matches_by_letter', matches_by_letter
-                return matches_by_letter
-
-        matches_by_stem = self.matcher_by_stem.match(word_cleaned, data_sources)
-        print 'matches_by_stem', matches_by_stem
-        if matches_by_stem:
-            res = [
-                w
-                for match_by_stem in matches_by_stem
-                for w in self.matcher_by_stem.lookup(match_by_stem)
+                self._require('by_letter')
+                for matches_by_letter in indexes.matcher_by_letter.routes(word_cleaned, data_sources, limit, ranked):
+                    logger.debug('matches_by_letter %s', matches_by_letter)
+                    yield 'by_letter', matches_by_letter[:limit]
+                return
+
+        mask = names.mask(data_sources)
+        combined = not ranked and indexes.combined_trie is not None
+        if combined:
+            combined_matches = self._combined_match(indexes, word_cleaned, mask)
+        for branch in ('stem', 'verbatim'):
+            self._require(branch)
+            matcher = getattr(indexes, self.MATCHER_ATTRIBUTES[branch])
+            if combined and combined_matches[branch] is not None:
+                matches = combined_matches[branch]
+            else:
+                # Verbatim matches are only missing when stem matches were found, so they are
+                # needed when tombstones hide all of those
+                matches = matcher.match(word_cleaned, data_sources, limit, ranked)
+            if ranked:
+                started = instrumentation.start()
+                res = [
+                    (distance, match, name_id)
+                    for distance, match in matches
+                    for name_id in names.filter_ids(matcher.lookup_ids(match), mask)
+                ][:limit]
+                if branch == 'stem':
+                    res = [_candidate(names, name_id, branch, data_sources, match, distance, None)
+                           for distance, match, name_id in res]
+                else:
+                    res = [_candidate(names, name_id, branch, data_sources, None, None, distance)
+                           for distance, _, name_id in res]
+                instrumentation.stage('lookup', started)
+                logger.debug('matches_by_%s %s (filtered %s)', branch, matches, res)
+                yield branch, res
+                continue
+            started = instrumentation.start()
+            name_ids = [
+                name_id
+                for match in matches
+                for name_id in matcher.lookup_ids(match)
             ]
+            instrumentation.stage('lookup', started)
+            started = instrumentation.start()
+            res = names.filter(name_ids, mask)
+            instrumentation.stage('filter', started)
+            logger.debug('matches_by_%s %s (filtered %s)', branch, matches, res)
+            yield branch, res
+
+    def _exact(self, word_cleaned, data_sources, branch, ranked=False, indexes=None):
+        # Names, or `Candidate`s when ranked, of `indexes`, the published ones of this finder by
+        # default, whose `branch` form ('stem' or 'verbatim') is the one of `word_cleaned`
+        if indexes is None:
+            indexes = self._index[0]
+        names = indexes.names
+        self._require(branch)
+        matcher = getattr(indexes, self.MATCHER_ATTRIBUTES[branch])
+        word_transformed = matcher.transform(word_cleaned)
+        name_ids = names.filter_ids(matcher.lookup_ids(word_transformed), names.mask(data_sources))
+        if not ranked:
+            return [names.name(name_id) for name_id in name_ids]
+        if branch == 'stem':
+            return [_candidate(names, name_id, branch, data_sources, word_transformed, 0, None)
+                    for name_id in name_ids]
+        return [_candidate(names, name_id, branch, data_sources, None, None, 0) for name_id in name_ids]
+
+    def _combined_match(self, indexes, word_cleaned, mask):
+        # Stem and verbatim matches of `word_cleaned` by branch, from one walk of the combined trie
+        # of `indexes`. The verbatim matches are None when there are stem matches.
+        instrumentation = self.instrumentation
+        stem, verbatim = indexes.matcher_by_stem, indexes.matcher_by_verbatim
+        word_stem, stem_lev = stem.automaton(word_cleaned)
+        word_verbatim, verbatim_lev = verbatim.automaton(word_cleaned)
+        trie = indexes.combined_trie
+        probes, visited = trie.probes, trie.visited
+        started = instrumentation.start()
+        stem_matches, verbatim_matches = trie.find_all_tagged(
+            stem_lev, verbatim_lev, mask, lambda word_stem_candidate: stem.accepts(word_stem, word_stem_candidate))
+        if verbatim_matches is not None:
+            verbatim_matches = [match for match in verbatim_matches if verbatim.accepts(word_verbatim, match)]
+        instrumentation.stage('walk', started)
+        instrumentation.count('probes', trie.probes - probes)
+        instrumentation.count('visited', trie.visited - visited)
+        return {'stem': stem_matches, 'verbatim': verbatim_matches}
+
+    def __pipeline(self, word_cleaned, data_sources=set(), limit=None, ranked=False):
+        logger.debug('request: %s | %s', word_cleaned, data_sources)
+        indexes, delta, tombstones, _ = self._index
+        ranked = ranked or limit is not None
+        if self.exact_first and not MatcherByGenusOnly.verify(word_cleaned) and \
+                not MatcherByLetter.verify(word_cleaned):
+            started = self.instrumentation.start()
+            branch, res = self.__exact(indexes, delta, tombstones, word_cleaned, data_sources, ranked)
+            self.instrumentation.stage('exact', started)
+            self.instrumentation.count('exact_hits' if res else 'exact_misses')
+            if res:
+                self.instrumentation.branch(branch)
+                return branch, res[:limit], True
+        delta_routes = delta._routes(word_cleaned, data_sources, limit, ranked) if delta is not None else None
+        # A name hidden by a tombstone can take the place of at most one of the closest names
+        indexes_limit = limit + len(tombstones) if limit is not None else None
+
+        branch, res = None, []
+        for branch, res in self._routes(word_cleaned, data_sources, indexes_limit, ranked, indexes):
+            if tombstones:
+                if ranked:
+                    res = [candidate for candidate in res if candidate.term not in tombstones]
+                else:
+                    res = [name for name in res if name not in tombstones]
+            if delta_routes is not None:
+                res = res + next(delta_routes)[1]
+            if res:
+                break
+        if ranked:
+            res = sorted(res, key=lambda candidate: candidate.distance)[:limit]
+        self.instrumentation.branch(branch)
+        logger.debug('res: %s', res)
+        return branch, res, False
+
+    def __exact(self, indexes, delta, tombstones, word_cleaned, data_sources, ranked):
+        # Branch and exact matches of `word_cleaned` in `indexes` and `delta`, stems first. They
+        # are the ones the fuzzy tier of the query uses too.
+        for branch in ('stem', 'verbatim'):
+            res = self._exact(word_cleaned, data_sources, branch, ranked, indexes)
+            if tombstones:
+                res = [r for r in res if (r.term if ranked else r) not in tombstones]
+            if delta is not None:
+                res = res + delta._exact(word_cleaned, data_sources, branch, ranked)
+            if res:
+                return branch, res
+        return None, []
+
+    def save(self, path):
+        # Writes a snapshot of all the indexes to be memory-mapped by `Finder.load`, with the
+        # updates merged in
+        indexes, delta, tombstones, delta_names = self._index
+        finder = self
+        if delta is not None or tombstones:
+            finder = self._build_finder(self._words_to_datasources(indexes, tombstones, delta_names),
+                                        self.build_workers)
+        writer = _SnapshotWriter()
+        _dump_finder(writer, finder, '')
+        writer.write(path)
+
+    @classmethod
+    def load(cls, path, cache_size=10000, automata_cache_size=1000):
+        # Finder over the memory-mapped snapshot at `path`. The arrays of the snapshot are not
+        # copied, so processes that load the same snapshot share its pages.
+        return _load_finder(_SnapshotReader(path), '', cache_size, automata_cache_size)
+
+    def find_all_matches(self, word, data_sources=set(), limit=None):
+        return self.find_all_matches_with_branch(word, data_sources, limit)[1]
+
+    def find_all_matches_with_branch(self, word, data_sources=set(), limit=None):
+        # Branch that answered the query ('genus_only', 'by_letter', 'stem' or 'verbatim', None
+        # when it failed) and the matching names. With `limit`, only the `limit` closest names are
+        # searched for, and they come ordered by edit distance to `word`.
+        if limit is None:
+            return self.__find(word, data_sources, None, False)[:2]
+        branch, candidates, _ = self.__find(word, data_sources, limit, True)
+        return branch, [candidate.term for candidate in candidates]
+
+    def find_all_candidates(self, word, data_sources=set(), limit=None):
+        # `Candidate`s of the names matching `word`, the closest first. With `limit`, only the
+        # `limit` closest are searched for.
+        return self.__find(word, data_sources, limit, True)[1]
+
+    def find_all_candidates_with_branch(self, word, data_sources=set(), limit=None):
+        return self.__find(word, data_sources, limit, True)[:2]
+
+    def _find_with_tier(self, word, data_sources, limit, ranked):
+        # `(branch, names, exact)`, or `(branch, candidates, exact)` when ranked, where `exact` is
+        # whether the exact tier answered, for `ShardedFinder`
+        return self.__find(word, data_sources, limit, ranked)
+
+    def __find(self, word, data_sources, limit, ranked):
+        instrumentation = self.instrumentation
+        instrumentation.begin_query()
+        branch, res, exact = None, [], False
+        try:
+            started = instrumentation.start()
+            word_cleaned = clean_word(word)
+            instrumentation.stage('normalization', started)
+            key = (word_cleaned, frozenset(data_sources), limit, ranked)
+            cached = self.results_cache.get(key)
+            if cached is None:
+                instrumentation.count('cache_misses')
+                generation = self.generation
+                branch, res, exact = self.__pipeline(word_cleaned, data_sources, limit, ranked)
+                if generation == self.generation:
+                    self.results_cache.put(key, (branch, res, exact))
+            else:
+                instrumentation.count('cache_hits')
+                branch, res, exact = cached
+            res = list(res)
+        except IndexNotReady:
+            raise
+        except Exception:
+            logger.exception('matching %r failed', word)
+            branch, res, exact = None, [], False
+        finally:
+            instrumentation.end_query(len(res))
+        return branch, res, exact
+
+    def find_all_matches_batch(self, words, data_sources=set(), workers=None, chunk_size=1000):
+        # Matches of every word of `words`, in input order. Equal words are matched once. With more
+        # than one chunk of `chunk_size` distinct words, the chunks are spread over `workers` forked
+        # processes (a process per core when None) that share this index copy-on-write.
+        distinct_words = []
+        word_ids = {}
+        for word in words:
+            if word not in word_ids:
+                word_ids[word] = len(distinct_words)
+                distinct_words.append(word)
+
+        if workers == 1 or len(distinct_words) <= chunk_size:
+            matches = [self.find_all_matches(word, data_sources) for word in distinct_words]
+        else:
+            with ForkedMatcher(self, workers) as matcher:
+                queries = [(word, data_sources) for word in distinct_words]
+                matches = [res for _, res in matcher.map(queries, chunk_size)]
+        # Equal words get lists of their own, like the cached results
+        return [list(matches[word_ids[word]]) for word in words]
 
-            if data_sources:
-                res = [r for r in res
-                       if len(data_sources.intersection(self.words_to_datasources[r]))]
-                print 'matches_by_stem (filtered)', res
 
-        else:
-            matches_by_verbatim = self.matcher_by_verbatim.match(word_cleaned, data_sources)
-            res = [
-                w
-                for match_by_verbatim in matches_by_verbatim
-                for w in self.matcher_by_verbatim.lookup(match_by_verbatim)
-            ]
-            print 'matches_by_verbatim', matches_by_verbatim
+def _fork_context():
+    # Multiprocessing context of the workers: forked, so that they inherit the indexes copy-on-write
+    import multiprocessing
 
-            if data_sources:
-                res = [r for r in res
-                       if len(data_sources.intersection(self.words_to_datasources[r]))]
-                print 'matches_by_verbatim (filtered)', res
+    return multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
 
-        print 'res:', res
-        return res
 
-    def find_all_matches(self, word, data_sources=set()):
+# Finder of the open `ForkedMatcher`, inherited by its forked workers
+_forked_finder = None
+
+
+def _match_chunk(queries):
+    return [_forked_finder.find_all_matches_with_branch(word, data_sources) for word, data_sources in queries]
+
+
+class ForkedMatcher(object):
+    # Pool of `workers` processes (a process per core when None) matching with `finder`, the
+    # `workers` attribute has their number. Workers are forked so that they inherit the finder
+    # copy-on-write instead of pickling the index, so only one `ForkedMatcher` can be open at a time.
+    def __init__(self, finder, workers=None):
+        global _forked_finder
+
+        # Workers do not get the matchers built after they are forked
+        finder.completed()
+        if _forked_finder is not None:
+            raise RuntimeError('another ForkedMatcher is open')
+        context = _fork_context()
+        _forked_finder = finder
+        self.workers = workers or context.cpu_count()
+        try:
+            self.pool = context.Pool(self.workers)
+        except BaseException:
+            _forked_finder = None
+            raise
+
+    def map(self, queries, chunk_size=1000):
+        # `(branch, names)` of every `(word, data_sources)` of `queries`, in order
+        chunks = [queries[start:start + chunk_size] for start in range(0, len(queries), chunk_size)]
+        matches = []
+        for chunk_matches in self.pool.imap(_match_chunk, chunks):
+            matches.extend(chunk_matches)
+        return matches
+
+    def close(self):
+        global _forked_finder
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            _forked_finder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.pool is not None:
+            self.pool.terminate()
+        self.close()
+
+
+def shard_of(word, shards):
+    # Shard of a name or a query among `shards`: by the first letter of the genus, folded like the
+    # verbatim matcher does, so genus only and abbreviated queries need the names of one shard
+    letter = MatcherByVerbatim.transform(clean_word(word)[:1])
+    return (zlib.crc32(letter.encode('utf-8')) & 0xffffffff) % shards
+
+
+def _serve_shard(finder_options, connection):
+    # Runs in the process of a shard: receives its names on `connection` in chunks of
+    # `(word, data_sources)` pairs up to an empty one and builds their finder, then answers the
+    # batches of `(word, data_sources, limit, ranked)` queries it receives, with whether the exact
+    # tier answered them, until it gets None
+    try:
+        words_to_datasources = {}
+        while True:
+            chunk = connection.recv()
+            if not chunk:
+                break
+            words_to_datasources.update(chunk)
+        finder = Finder(words_to_datasources, **finder_options)
+    except BaseException:
         import traceback
+        connection.send(('error', traceback.format_exc()))
+        raise
+    del words_to_datasources
+    connection.send(('ready', len(finder.names)))
+    while True:
         try:
-            return self.__pipeline(word, data_sources)
-        except Exception as ex:
-            print ex
-            traceback.print_exc()
-            return []
+            queries = connection.recv()
+        except EOFError:
+            break
+        if queries is None:
+            break
+        connection.send([finder._find_with_tier(word, data_sources, limit, ranked)
+                         for word, data_sources, limit, ranked in queries])
+    connection.close()
+
+
+def _merge_shards(results, limit, ranked):
+    # `(branch, names)`, or `(branch, candidates)` when ranked, of a query from the
+    # `(branch, names or candidates, exact)` of the shards it was sent to. As in a single `Finder`,
+    # the answers of the exact tier of any shard win over the fuzzy matches of the others, and the
+    # stem matches win over the verbatim matches.
+    if len(results) == 1:
+        return results[0][:2]
+    if any(exact and res for _, res, exact in results):
+        results = [result for result in results if result[2] and result[1]]
+    branches = [branch for branch, _, _ in results]
+    if any(branch == 'stem' and res for branch, res, _ in results):
+        branch = 'stem'
+        res = [r for shard_branch, shard_res, _ in results if shard_branch == 'stem' for r in shard_res]
+    else:
+        branch = 'verbatim' if 'verbatim' in branches else None
+        res = [r for _, shard_res, _ in results for r in shard_res]
+    if ranked:
+        res = sorted(res, key=lambda candidate: candidate.distance)[:limit]
+    return branch, res
+
+
+class ShardedFinder(object):
+    # Catalogue split into `shards` partitions by `shard_of`, each with the `Finder` of its names
+    # in a forked process. The coordinator sends genus only and abbreviated queries to the shard of
+    # their letter and the other queries to every shard, over pipes, and merges the answers.
+    # Shards are forked before the catalogue is partitioned and get their names over the pipes, so
+    # only the process of a shard holds its partition. The objects of the coordinator are frozen
+    # while forking (Python 3.7 and later), so the collections of the shards do not copy their pages.
+    # finder_options: keyword arguments of the `Finder` of every shard
+    # Names sent to a shard at a time
+    CHUNK_SIZE = 10000
+
+    def __init__(self, words_to_datasources, shards=4, **finder_options):
+        import gc
+
+        context = _fork_context()
+        self.shards = shards
+        self.connections = []
+        self.processes = []
+        self.sizes = []
+        try:
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+            try:
+                for _ in range(shards):
+                    connection, shard_connection = context.Pipe()
+                    process = context.Process(target=_serve_shard, args=(finder_options, shard_connection))
+                    process.daemon = True
+                    process.start()
+                    shard_connection.close()
+                    self.connections.append(connection)
+                    self.processes.append(process)
+            finally:
+                if hasattr(gc, 'unfreeze'):
+                    gc.unfreeze()
+            chunks = [[] for _ in range(shards)]
+            for word, data_sources in _iteritems(words_to_datasources):
+                shard = shard_of(word, shards)
+                chunks[shard].append((word, data_sources))
+                if len(chunks[shard]) >= self.CHUNK_SIZE:
+                    self.connections[shard].send(chunks[shard])
+                    chunks[shard] = []
+            for shard, chunk in enumerate(chunks):
+                if chunk:
+                    self.connections[shard].send(chunk)
+                self.connections[shard].send([])
+            # Shards are built in parallel, the coordinator only waits for them
+            for shard, connection in enumerate(self.connections):
+                kind, value = self._receive(shard)
+                if kind == 'error':
+                    raise RuntimeError('building shard %d failed:\n%s' % (shard, value))
+                self.sizes.append(value)
+        except BaseException:
+            self.close()
+            raise
+        logger.info('%d shards ready, names by shard %s', shards, self.sizes)
+
+    def _receive(self, shard):
+        try:
+            return self.connections[shard].recv()
+        except EOFError:
+            raise RuntimeError('shard %d exited with code %s' % (shard, self.processes[shard].exitcode))
+
+    def _shards_of(self, word):
+        word_cleaned = clean_word(word)
+        if MatcherByGenusOnly.verify(word_cleaned) or MatcherByLetter.verify(word_cleaned):
+            return [shard_of(word_cleaned, self.shards)]
+        return range(self.shards)
+
+    def map(self, queries, limit=None, ranked=False):
+        # `(branch, names)` of every `(word, data_sources)` of `queries`, in order. When ranked or
+        # with `limit`, `(branch, candidates)` of up to `limit` `Candidate`s, the closest first.
+        ranked = ranked or limit is not None
+        batches = [[] for _ in range(self.shards)]
+        routes = []
+        for word, data_sources in queries:
+            shards = self._shards_of(word)
+            for shard in shards:
+                batches[shard].append((word, data_sources, limit, ranked))
+            routes.append(shards)
+        for shard, batch in enumerate(batches):
+            if batch:
+                self.connections[shard].send(batch)
+        results = [iter(self._receive(shard)) if batch else None for shard, batch in enumerate(batches)]
+        return [_merge_shards([next(results[shard]) for shard in shards], limit, ranked) for shards in routes]
+
+    def find_all_matches(self, word, data_sources=set(), limit=None):
+        return self.find_all_matches_with_branch(word, data_sources, limit)[1]
+
+    def find_all_matches_with_branch(self, word, data_sources=set(), limit=None):
+        branch, res = self.map([(word, data_sources)], limit)[0]
+        if limit is not None:
+            res = [candidate.term for candidate in res]
+        return branch, res
+
+    def find_all_candidates(self, word, data_sources=set(), limit=None):
+        return self.map([(word, data_sources)], limit, True)[0][1]
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (IOError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _log_progress(matcher, done, total):
+    logger.debug('%s: %d of %d names', matcher, done, total)
+
+
+class _FinderBuild(object):
+    # Construction of the `matchers` of `finder`, here or in up to `workers` forked processes that
+    # build a matcher each and hand it over as a snapshot file. The event of a matcher is set once
+    # it is in `finder`.
+    def __init__(self, finder, words_to_datasources, matchers, automata_cache_size, workers, progress):
+        self.finder = finder
+        self.words_to_datasources = words_to_datasources
+        self.matchers = matchers
+        self.automata_cache_size = automata_cache_size
+        self.workers = workers
+        self.progress = progress if progress is not None else _log_progress
+        self.events = dict((matcher, threading.Event()) for matcher in matchers)
+        self.error = None
+
+    def is_ready(self, matcher=None):
+        if self.error is not None:
+            return False
+        if matcher is None:
+            return all(event.is_set() for event in self.events.values())
+        return self.events[matcher].is_set()
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        for event in self.events.values():
+            if not event.wait(max(0, deadline - time.time()) if deadline is not None else None):
+                return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def start(self):
+        thread = threading.Thread(target=self._run_in_background, name='finder-build')
+        thread.daemon = True
+        thread.start()
+
+    def _run_in_background(self):
+        try:
+            self.run()
+        except Exception:
+            logger.exception('building the finder failed')
+
+    def run(self):
+        import multiprocessing
+
+        try:
+            workers = min(self.workers or multiprocessing.cpu_count(), len(self.matchers))
+            if workers == 1:
+                for matcher in self.matchers:
+                    self._set(matcher, self._new_matcher(matcher, self.progress))
+            else:
+                self._run_forked(workers)
+        except BaseException as ex:
+            self.error = ex
+            # Wakes up the waiters, that raise the error
+            for event in self.events.values():
+                event.set()
+            raise
+        finally:
+            self.words_to_datasources = None
+        self.finder._build = None
+
+    def _new_matcher(self, matcher, progress):
+        def matcher_progress(done, total):
+            progress(matcher, done, total)
+        return self.finder._new_matcher(matcher, self.words_to_datasources, self.automata_cache_size,
+                                        matcher_progress)
+
+    def _set(self, matcher, value):
+        self.finder._set_matcher(matcher, value)
+        total = len(self.finder.names)
+        self.progress(matcher, total, total)
+        self.events[matcher].set()
+
+    def _run_forked(self, workers):
+        import tempfile
+
+        context = _fork_context()
+        messages = context.Queue()
+        waiting = list(self.matchers)
+        # Process and snapshot path by matcher
+        running = {}
+        try:
+            while waiting or running:
+                while waiting and len(running) < workers:
+                    matcher = waiting.pop(0)
+                    fd, path = tempfile.mkstemp(prefix='gnmatcher-', suffix='.snapshot')
+                    os.close(fd)
+                    process = context.Process(target=self._build_forked, args=(matcher, path, messages))
+                    process.daemon = True
+                    running[matcher] = (process, path)
+                    process.start()
+
+                try:
+                    kind, matcher, done, total = messages.get(timeout=1)
+                except queue.Empty:
+                    for matcher, (process, _) in running.items():
+                        if process.exitcode:
+                            raise RuntimeError('building the %s matcher failed with exit code %d' %
+                                               (matcher, process.exitcode))
+                    continue
+                if kind == 'progress':
+                    self.progress(matcher, done, total)
+                elif kind == 'error':
+                    raise RuntimeError('building the %s matcher failed:\n%s' % (matcher, done))
+                else:
+                    process, path = running.pop(matcher)
+                    process.join()
+                    try:
+                        reader = _SnapshotReader(path)
+                    finally:
+                        # The mapping outlives the file
+                        os.remove(path)
+                    self._set(matcher, _load_matcher(reader, matcher, self.finder, '', self.automata_cache_size))
+        finally:
+            for process, path in running.values():
+                process.terminate()
+                process.join()
+                os.remove(path)
+
+    def _build_forked(self, matcher, path, messages):
+        # Runs in a forked worker: writes `matcher` to the snapshot at `path`
+        def progress(matcher, done, total):
+            messages.put(('progress', matcher, done, total))
+
+        try:
+            writer = _SnapshotWriter()
+            _dump_matcher(writer, matcher, self._new_matcher(matcher, progress), '')
+            writer.write(path)
+        except BaseException:
+            import traceback
+            messages.put(('error', matcher, traceback.format_exc(), None))
+            raise
+        messages.put(('done', matcher, None, None))
+
+
+SNAPSHOT_MAGIC = b'GNMATCH\0'
+SNAPSHOT_VERSION = 3
+
+
+class _SnapshotWriter(object):
+    # Snapshot layout: magic, version and header length, the JSON header, then the sections
+    # aligned to 8 bytes. The header keeps `meta` and the offset, item count, typecode and item
+    # size of every section.
+    def __init__(self):
+        self.meta = {}
+        self.sections = []
+
+    def add_array(self, name, typecode, values):
+        values = array(typecode, values)
+        data = values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+        self.sections.append((name, typecode, values.itemsize, len(values), data))
+
+    def add_strings(self, name, strings):
+        strings = StringTable.from_strings(strings)
+        self.add_array(name + '.blob', 'B', array('B', strings.blob))
+        self.add_array(name + '.ends', 'l', strings.ends)
+
+    def add_postings(self, name, postings):
+        self.add_array(name + '.values', 'i', postings.values)
+        self.add_array(name + '.ends', 'l', postings.ends)
+
+    def write(self, path):
+        sections = {}
+        offset = 0
+        for name, typecode, itemsize, count, data in self.sections:
+            sections[name] = [offset, count, typecode, itemsize]
+            offset += (len(data) + 7) // 8 * 8
+        header = json.dumps({'byteorder': sys.byteorder, 'meta': self.meta,
+                             'sections': sections}).encode('utf-8')
+        data_start = (len(SNAPSHOT_MAGIC) + 8 + len(header) + 7) // 8 * 8
+
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<II', SNAPSHOT_VERSION, len(header)))
+            f.write(header)
+            f.write(b'\0' * (data_start - len(SNAPSHOT_MAGIC) - 8 - len(header)))
+            for _, _, _, _, data in self.sections:
+                f.write(data)
+                f.write(b'\0' * ((len(data) + 7) // 8 * 8 - len(data)))
+
+
+class _SnapshotReader(object):
+    def __init__(self, path):
+        import mmap
+
+        with open(path, 'rb') as f:
+            # Copy-on-write mapping: the pages stay shared as nothing writes to them
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic_len = len(SNAPSHOT_MAGIC)
+        if self.mm[:magic_len] != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a matcher snapshot' % path)
+        version, header_len = struct.unpack('<II', self.mm[magic_len:magic_len + 8])
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('snapshot %s has version %d, expected %d' % (path, version, SNAPSHOT_VERSION))
+        header = json.loads(self.mm[magic_len + 8:magic_len + 8 + header_len].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('snapshot %s was written with %s byte order' % (path, header['byteorder']))
+        self.meta = header['meta']
+        self.sections = header['sections']
+        self.data_start = (magic_len + 8 + header_len + 7) // 8 * 8
+
+    def array(self, name):
+        import ctypes
+
+        offset, count, typecode, itemsize = self.sections[name]
+        if count == 0:
+            return array(typecode)
+        ctype = {('B', 1): ctypes.c_uint8, ('i', 4): ctypes.c_int32,
+                 ('l', 4): ctypes.c_int32, ('l', 8): ctypes.c_int64}[(typecode, itemsize)]
+        return (ctype * count).from_buffer(self.mm, self.data_start + offset)
+
+    def strings(self, name):
+        offset = self.sections[name + '.blob'][0]
+        return StringTable(self.mm, self.data_start + offset, self.array(name + '.ends'))
+
+    def postings(self, name):
+        return Postings(self.array(name + '.ends'), self.array(name + '.values'))
+
+
+def _dump_trie(writer, trie, prefix):
+    labels = _to_text(trie.labels)
+    if len(labels) != len(trie.labels):
+        raise ValueError('snapshots need unicode words')
+    writer.meta[prefix + 'bitmaps'] = ['%x' % bitmap for bitmap in trie.bitmaps]
+    writer.add_strings(prefix + 'keys', trie.keys)
+    writer.add_array(prefix + 'keys_bitmap_ids', 'i', trie.keys_bitmap_ids)
+    writer.add_array(prefix + 'labels', 'B', array('B', labels.encode('utf-32-le')))
+    writer.add_array(prefix + 'ends', 'i', trie.ends)
+    writer.add_array(prefix + 'terminals', 'i', trie.terminals)
+    writer.add_array(prefix + 'bitmap_ids', 'i', trie.bitmap_ids)
+
+
+def _load_trie(reader, prefix, cls=Trie):
+    trie = cls.__new__(cls)
+    trie.probes = 0
+    trie.visited = 0
+    trie.bitmaps = [int(bitmap, 16) for bitmap in reader.meta[prefix + 'bitmaps']]
+    trie.keys = reader.strings(prefix + 'keys')
+    trie.keys_bitmap_ids = reader.array(prefix + 'keys_bitmap_ids')
+    # Labels are decoded in one pass to have a string to index in the trie walk
+    offset, count = reader.sections[prefix + 'labels'][:2]
+    start = reader.data_start + offset
+    trie.labels = reader.mm[start:start + count].decode('utf-32-le')
+    trie.ends = reader.array(prefix + 'ends')
+    trie.terminals = reader.array(prefix + 'terminals')
+    trie.bitmap_ids = reader.array(prefix + 'bitmap_ids')
+    return trie
+
+
+def _dump_names(writer, names, prefix):
+    writer.meta[prefix + 'names'] = {
+        'bits': [[data_source, bit.bit_length() - 1] for data_source, bit in names.bits.items()],
+        'bitmaps': ['%x' % bitmap for bitmap in names.bitmaps],
+    }
+    writer.add_strings(prefix + 'names', names.names)
+    writer.add_array(prefix + 'names_bitmap_ids', 'i', names.bitmap_ids)
+
+
+def _load_names(reader, prefix):
+    meta = reader.meta[prefix + 'names']
+    names = NameTable.__new__(NameTable)
+    names.names = reader.strings(prefix + 'names')
+    # JSON turns the `(letter, data_source)` tags of `MatcherByLetter` into lists
+    names.bits = dict((tuple(data_source) if isinstance(data_source, list) else data_source, 1 << bit)
+                      for data_source, bit in meta['bits'])
+    names.bitmaps = [int(bitmap, 16) for bitmap in meta['bitmaps']]
+    names.bitmap_ids = reader.array(prefix + 'names_bitmap_ids')
+    return names
+
+
+def _dump_gram_filter(writer, gram_filter, prefix):
+    if gram_filter is None:
+        return
+    writer.meta[prefix + 'gram_filter'] = {'q': gram_filter.q, 'max_edits': gram_filter.max_edits,
+                                           'hashes': gram_filter.hashes}
+    writer.add_array(prefix + 'gram_filter', 'B', gram_filter.bits)
+
+
+def _load_gram_filter(reader, prefix):
+    meta = reader.meta.get(prefix + 'gram_filter')
+    if meta is None:
+        return None
+    return QGramFilter(reader.array(prefix + 'gram_filter'), meta['q'], meta['max_edits'], meta['hashes'])
+
+
+def _dump_matcher(writer, matcher, value, prefix):
+    if matcher in ('stem', 'verbatim'):
+        _dump_trie(writer, value.trie, prefix + matcher + '/')
+        writer.add_postings(prefix + matcher + '/words', getattr(value, value.NAME_IDS_ATTRIBUTE))
+        _dump_gram_filter(writer, value.gram_filter, prefix + matcher + '/')
+    elif matcher == 'genus_only':
+        writer.add_strings(prefix + 'genus_only/keys', value.words_genus_only)
+        writer.add_postings(prefix + 'genus_only/words', value.words_genus_only_to_words)
+    else:
+        writer.meta.setdefault(prefix + 'finder', {})['letters'] = sorted(value.letters)
+        _dump_finder(writer, value.finder, prefix + 'letter/')
+        writer.add_postings(prefix + 'letter/words_full', value.words_rest_to_words_full)
+
+
+def _dump_finder(writer, finder, prefix):
+    finder.completed()
+    # `letters` is set by the dump of the `MatcherByLetter`
+    writer.meta[prefix + 'finder'] = {
+        'matcher_by_letter_context': finder.matcher_by_letter_context,
+        'part_budgets': finder.part_budgets,
+        'verify_threshold': finder.verify_threshold,
+        'engine': {'name': finder.engine.name, 'options': finder.engine.options()},
+        'exact_first': finder.exact_first,
+        'gram_filter': finder.gram_filter,
+        'combined_search': finder.combined_search,
+        'letters': [],
+    }
+    _dump_names(writer, finder.names, prefix)
+    for matcher in ('verbatim', 'stem') if finder.matcher_by_letter_context else Finder.MATCHERS:
+        _dump_matcher(writer, matcher, getattr(finder, Finder.MATCHER_ATTRIBUTES[matcher]), prefix)
+    if finder.combined_trie is not None:
+        _dump_trie(writer, finder.combined_trie, prefix + 'combined/')
+        writer.add_array(prefix + 'combined/stem_bitmap_ids', 'i', finder.combined_trie.stem_bitmap_ids)
+        writer.add_array(prefix + 'combined/verbatim_bitmap_ids', 'i', finder.combined_trie.verbatim_bitmap_ids)
+        writer.add_array(prefix + 'combined/tags', 'B', finder.combined_trie.tags)
+
+
+def _load_matcher(reader, matcher, finder, prefix, automata_cache_size):
+    # `matcher` of `finder` from the snapshot
+    if matcher in ('stem', 'verbatim'):
+        cls = MatcherByStem if matcher == 'stem' else MatcherByVerbatim
+        value = cls.__new__(cls)
+        value.engine = finder.engine
+        value.part_budgets = finder.part_budgets
+        value.verify_threshold = finder.verify_threshold
+        value.names = finder.names
+        value.automata_cache = finder.automata_cache
+        value.instrumentation = NULL_INSTRUMENTATION
+        setattr(value, cls.TRIE_ATTRIBUTE, _load_trie(reader, prefix + matcher + '/'))
+        setattr(value, cls.NAME_IDS_ATTRIBUTE, reader.postings(prefix + matcher + '/words'))
+        value.gram_filter = _load_gram_filter(reader, prefix + matcher + '/')
+        # Only the trie is in the snapshot, the index of another engine is built from its keys
+        value.index = finder.engine.index(value.trie)
+        return value
+
+    if matcher == 'genus_only':
+        value = MatcherByGenusOnly.__new__(MatcherByGenusOnly)
+        value.names = finder.names
+        value.words_genus_only = reader.strings(prefix + 'genus_only/keys')
+        value.words_genus_only_to_words = reader.postings(prefix + 'genus_only/words')
+        return value
+
+    value = MatcherByLetter.__new__(MatcherByLetter)
+    value.names = finder.names
+    value.letters = set(reader.meta[prefix + 'finder']['letters'])
+    value.finder = _load_finder(reader, prefix + 'letter/', 0, automata_cache_size)
+    value.words_rest_to_words_full = reader.postings(prefix + 'letter/words_full')
+    return value
+
+
+def _load_finder(reader, prefix, cache_size, automata_cache_size):
+    meta = reader.meta[prefix + 'finder']
+    finder = Finder.__new__(Finder)
+    finder._init_caches(cache_size, automata_cache_size)
+    finder._init_index(_load_names(reader, prefix))
+    finder._build = None
+    finder.instrumentation = NULL_INSTRUMENTATION
+    engine = meta.get('engine')
+    finder.engine = new_engine(engine['name'], **engine['options']) if engine is not None else AUTOMATON_ENGINE
+    finder.exact_first = meta.get('exact_first', False)
+    finder.gram_filter = meta.get('gram_filter', False)
+    finder.combined_search = meta.get('combined_search', False)
+    finder.part_budgets = meta['part_budgets']
+    finder.verify_threshold = meta['verify_threshold']
+    finder.build_workers = 1
+    finder.matcher_by_letter_context = meta['matcher_by_letter_context']
+    for matcher in ('verbatim', 'stem') if finder.matcher_by_letter_context else Finder.MATCHERS:
+        setattr(finder, Finder.MATCHER_ATTRIBUTES[matcher],
+                _load_matcher(reader, matcher, finder, prefix, automata_cache_size))
+    if prefix + 'combined/bitmaps' in reader.meta:
+        finder.combined_trie = _load_trie(reader, prefix + 'combined/', TaggedTrie)
+        finder.combined_trie.stem_bitmap_ids = reader.array(prefix + 'combined/stem_bitmap_ids')
+        finder.combined_trie.verbatim_bitmap_ids = reader.array(prefix + 'combined/verbatim_bitmap_ids')
+        finder.combined_trie.tags = reader.array(prefix + 'combined/tags')
+    return finder
@@ -0,0 +1,309 @@
+"""Benchmark of the `automata.Finder` pipeline.
+
+Builds a catalogue of synthetic uninomials, binomials and trinomials from the words of
+`latin_words.txt`, matches generated queries against it and reports the build time, the peak
+memory and the latency percentiles and throughput of the queries, in total and by the pipeline
+branch that answered them. Everything is seeded, so runs with the same options are comparable:
+
+    python benchmark.py --names 100000 --queries 5000 --output run.json
+
+With several `--engine`s, each one is benchmarked in its own process, so that the peak memory
+of one does not hide the one of the other, and the reports are keyed by engine:
+
+    python benchmark.py --engine automaton --engine symmetric_delete --prefix-length 5
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import automata
+
+DEFAULT_WORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..', '..', '..', 'test', 'resources', 'latin_words.txt')
+
+# Kinds of generated queries and their default weights
+QUERY_KINDS = (
+    ('exact', 2),
+    ('typo', 3),
+    ('typos', 2),
+    ('glued', 1),
+    ('split', 1),
+    ('abbreviated', 1),
+    ('genus_only', 1),
+    ('upper', 1),
+)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def load_words(path=DEFAULT_WORDS_PATH, min_length=4):
+    # First column of the word list, lower-cased, alphabetic words only
+    words = set()
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0].isalpha() and len(parts[0]) >= min_length:
+                words.add(parts[0].lower())
+    return sorted(words)
+
+
+def build_catalogue(words, size, seed=1, genera_ratio=0.1, uninomials=0.1, trinomials=0.2, data_sources=12):
+    # `size` distinct names with 1 to 3 random datasources each. Genera are capitalized words,
+    # about `genera_ratio` of the names, the epithets are drawn from all the words.
+    rnd = random.Random(seed)
+    genera = [word.capitalize() for word in rnd.sample(words, max(3, min(len(words), int(size * genera_ratio))))]
+    catalogue = {}
+    while len(catalogue) < size:
+        genus = rnd.choice(genera)
+        kind = rnd.random()
+        if kind < uninomials:
+            name = genus
+        elif kind < uninomials + trinomials:
+            name = ' '.join((genus, rnd.choice(words), rnd.choice(words)))
+        else:
+            name = ' '.join((genus, rnd.choice(words)))
+        catalogue[name] = set(rnd.sample(range(1, data_sources + 1), rnd.randint(1, 3)))
+    return catalogue
+
+
+def _typo(rnd, word):
+    idx = rnd.randrange(len(word))
+    edit = rnd.randrange(3)
+    letter = rnd.choice('abcdefghilmnoprstu')
+    if edit == 0:
+        return word[:idx] + word[idx + 1:]
+    if edit == 1:
+        return word[:idx] + letter + word[idx + 1:]
+    return word[:idx] + letter + word[idx:]
+
+
+def make_query(rnd, name, kind):
+    # Query of `kind` derived from `name`, or None when the name does not allow it
+    parts = name.split(' ')
+    if kind == 'exact':
+        return name
+    if kind == 'typo':
+        return _typo(rnd, name)
+    if kind == 'typos':
+        return _typo(rnd, _typo(rnd, name))
+    if kind == 'glued':
+        if len(parts) < 2:
+            return None
+        idx = rnd.randrange(1, len(parts))
+        return ' '.join(parts[:idx - 1] + [parts[idx - 1] + parts[idx]] + parts[idx + 1:])
+    if kind == 'split':
+        part_idx = rnd.randrange(len(parts))
+        part = parts[part_idx]
+        if len(part) < 6:
+            return None
+        idx = rnd.randrange(2, len(part) - 2)
+        return ' '.join(parts[:part_idx] + [part[:idx], part[idx:]] + parts[part_idx + 1:])
+    if kind == 'abbreviated':
+        if len(parts) < 2:
+            return None
+        return ' '.join([parts[0][0] + '.'] + parts[1:])
+    if kind == 'genus_only':
+        return parts[0]
+    if kind == 'upper':
+        return name.upper()
+    raise ValueError('unknown query kind %r' % kind)
+
+
+def make_queries(catalogue, count, seed=2, kinds=QUERY_KINDS):
+    # `count` pairs of query kind and query, derived from random names of `catalogue`
+    rnd = random.Random(seed)
+    names = sorted(catalogue)
+    kinds_names = [kind for kind, _ in kinds]
+    weights = [weight for _, weight in kinds]
+    total = float(sum(weights))
+    queries = []
+    while len(queries) < count:
+        pick = rnd.random() * total
+        kind_idx = 0
+        while pick >= weights[kind_idx] and kind_idx < len(weights) - 1:
+            pick -= weights[kind_idx]
+            kind_idx += 1
+        query = make_query(rnd, rnd.choice(names), kinds_names[kind_idx])
+        if query is not None:
+            queries.append((kinds_names[kind_idx], query))
+    return queries
+
+
+def _peak_memory_mb():
+    # Peak resident memory of the process, None where it can not be measured
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _rate(counters, hits, misses):
+    total = counters.get(hits, 0) + counters.get(misses, 0)
+    return {'checked': total, 'rate': counters.get(hits, 0) / float(total) if total else None}
+
+
+def _latencies_summary(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'queries': len(latencies),
+        'total_seconds': total,
+        'throughput_qps': len(latencies) / total if total else None,
+        'p50_ms': _percentile(latencies, 0.5) * 1000 if latencies else None,
+        'p90_ms': _percentile(latencies, 0.9) * 1000 if latencies else None,
+        'p99_ms': _percentile(latencies, 0.99) * 1000 if latencies else None,
+        'max_ms': latencies[-1] * 1000 if latencies else None,
+    }
+
+
+def run(names=20000, queries=2000, seed=1, data_sources=(), words_path=DEFAULT_WORDS_PATH,
+        part_budgets=False, cache_size=0, snapshot=None, build_workers=1, engine='automaton', engine_options=None,
+        exact_first=False, gram_filter=False, combined_search=False):
+    # Runs the benchmark and returns its report as plain data. The results cache is disabled by
+    # default so that every query walks the index. With `snapshot`, the finder is saved to and
+    # loaded from that path and the load time is reported too. `engine` and `engine_options` are
+    # passed to `automata.new_engine`.
+    engine = automata.new_engine(engine, **(engine_options or {}))
+    words = load_words(words_path)
+    catalogue = build_catalogue(words, names, seed=seed)
+    query_kinds = make_queries(catalogue, queries, seed=seed + 1)
+    data_sources = set(data_sources)
+
+    memory_before = _peak_memory_mb()
+    started = _timer()
+    finder = automata.Finder(catalogue, part_budgets=part_budgets, cache_size=cache_size, build_workers=build_workers,
+                             engine=engine, exact_first=exact_first, gram_filter=gram_filter,
+                             combined_search=combined_search)
+    build_seconds = _timer() - started
+    memory_after = _peak_memory_mb()
+
+    load_seconds = None
+    if snapshot is not None:
+        finder.save(snapshot)
+        started = _timer()
+        finder = automata.Finder.load(snapshot, cache_size=cache_size)
+        load_seconds = _timer() - started
+
+    stats = automata.QueryStats()
+    finder.set_instrumentation(stats)
+    latencies = []
+    by_branch = {}
+    by_kind = {}
+    results = 0
+    for kind, query in query_kinds:
+        started = _timer()
+        matches = finder.find_all_matches(query, data_sources)
+        latency = _timer() - started
+        results += len(matches)
+        latencies.append(latency)
+        # The first branch is the one of the outer query, the epithet queries come after it
+        branches = stats.last_query['branches']
+        branch = branches[0] if branches else 'cached'
+        by_branch.setdefault(branch, []).append(latency)
+        by_kind.setdefault(kind, []).append(latency)
+
+    stages = stats.export()
+    return {
+        'config': {
+            'names': names, 'queries': queries, 'seed': seed, 'data_sources': sorted(data_sources),
+            'part_budgets': part_budgets, 'cache_size': cache_size, 'snapshot': snapshot is not None,
+            'build_workers': build_workers, 'engine': engine.name, 'engine_options': engine.options(),
+            'exact_first': exact_first, 'gram_filter': gram_filter, 'combined_search': combined_search,
+        },
+        'environment': {
+            'python': platform.python_implementation() + ' ' + platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'build': {
+            'seconds': build_seconds,
+            'load_seconds': load_seconds,
+            'peak_memory_mb': memory_after,
+            'peak_memory_growth_mb': memory_after - memory_before if memory_after is not None else None,
+        },
+        'queries': dict(_latencies_summary(latencies), results=results),
+        'branches': dict((branch, _latencies_summary(values)) for branch, values in by_branch.items()),
+        'kinds': dict((kind, _latencies_summary(values)) for kind, values in by_kind.items()),
+        'stages': stages,
+        # Share of the checked queries answered by the exact tier, and of the words the q-gram
+        # filter ruled out
+        'tiers': {
+            'exact_hits': _rate(stages['counters'], 'exact_hits', 'exact_misses'),
+            'gram_filter_rejects': _rate(stages['counters'], 'gram_filter_rejects', 'gram_filter_passes'),
+        },
+    }
+
+
+def _run_in_process(kwargs):
+    # `run` in a child process, with a peak memory of its own
+    import multiprocessing
+
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run, (), kwargs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the automata.Finder pipeline')
+    parser.add_argument('--names', type=int, default=20000, help='names in the catalogue')
+    parser.add_argument('--queries', type=int, default=2000, help='queries to match')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the catalogue and the queries')
+    parser.add_argument('--data-source', type=int, action='append', default=[],
+                        help='datasource to filter by, may be repeated')
+    parser.add_argument('--words', default=DEFAULT_WORDS_PATH, help='word list to build names from')
+    parser.add_argument('--part-budgets', action='store_true', help='build finders with part_budgets')
+    parser.add_argument('--cache-size', type=int, default=0, help='results cache capacity')
+    parser.add_argument('--build-workers', type=int, default=1,
+                        help='processes building the finder, 0 for one per core')
+    parser.add_argument('--engine', action='append', choices=sorted(automata.ENGINES),
+                        help='search engine of the indexes, may be repeated to compare them (automaton by default)')
+    parser.add_argument('--max-distance', type=int, default=2, help='edits covered by the symmetric_delete index')
+    parser.add_argument('--prefix-length', type=int, default=7,
+                        help='characters of the keys in the symmetric_delete index, 0 for all of them')
+    parser.add_argument('--exact-first', action='store_true', help='answer exact stem or verbatim hits directly')
+    parser.add_argument('--gram-filter', action='store_true', help='rule out words with a q-gram filter first')
+    parser.add_argument('--combined-search', action='store_true',
+                        help='search the stem and verbatim forms in one walk')
+    parser.add_argument('--snapshot', help='save the finder to this path and query the loaded snapshot')
+    parser.add_argument('--output', help='write the JSON report to this path instead of stdout')
+    args = parser.parse_args(argv)
+
+    kwargs = dict(names=args.names, queries=args.queries, seed=args.seed, data_sources=args.data_source,
+                  words_path=args.words, part_budgets=args.part_budgets, cache_size=args.cache_size,
+                  snapshot=args.snapshot, build_workers=args.build_workers or None,
+                  exact_first=args.exact_first, gram_filter=args.gram_filter,
+                  combined_search=args.combined_search)
+    engines = args.engine or ['automaton']
+    options = {'symmetric_delete': {'max_distance': args.max_distance, 'prefix_length': args.prefix_length or None}}
+    if len(engines) == 1:
+        report = run(engine=engines[0], engine_options=options.get(engines[0]), **kwargs)
+    else:
+        report = {'engines': dict((engine, _run_in_process(dict(kwargs, engine=engine,
+                                                                 engine_options=options.get(engine))))
+                                  for engine in engines)}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""Asyncio HTTP front-end of `automata.Finder` (Python 3).
+
+    python3 -m match_server --snapshot finder.snapshot --port 8080
+
+Endpoints:
+
+* `GET /ready`: 200 once all the matchers are built, 503 before, with the readiness of every
+  matcher. Queries that only need the matchers already built are answered meanwhile, the others
+  get a 503.
+* `GET /match?name=...&data_source=1&data_source=2` or `POST /match` with a JSON body
+  `{"name": ..., "data_sources": [...]}`: `{"name", "data_sources", "branch", "matches"}`.
+* `GET /stats`: counters of the service.
+
+Identical queries in flight share one computation. Distinct queries are collected into
+micro-batches of up to `max_batch_size` queries or `max_delay` seconds and matched in an executor,
+so the event loop never runs the matching. A request is refused with 429 when `max_pending`
+queries are waiting, and fails with 504 after `timeout` seconds.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import automata
+
+logger = logging.getLogger(__name__)
+
+
+class NotReady(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class MatchService:
+    def __init__(self, load_finder, max_batch_size=64, max_delay=0.005, max_pending=10000, timeout=5.0,
+                 workers=1):
+        # load_finder: callable returning the `automata.Finder`, run in the executor by `start`
+        # workers: processes matching the batches, more than 1 forks them with `automata.ForkedMatcher`
+        # The finder may still be building its matchers, see `automata.Finder.completed`
+        self.load_finder = load_finder
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.workers = workers
+        self.finder = None
+        self.forked_matcher = None
+        self.loading_error = None
+        # Matching runs in one thread at a time: the finder caches are not thread-safe
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.in_flight = {}
+        self.queue = None
+        self.batcher = None
+        self.counters = {'requests': 0, 'coalesced': 0, 'batches': 0, 'batched_queries': 0,
+                         'overloaded': 0, 'timeouts': 0}
+
+    @property
+    def ready(self):
+        return self.finder is not None
+
+    async def start(self):
+        # Starts loading the index and batching, returns without waiting for the index
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self._batch_loop())
+        asyncio.ensure_future(self._load())
+
+    async def _load(self):
+        loop = asyncio.get_event_loop()
+        started = time.time()
+        try:
+            finder = await loop.run_in_executor(self.executor, self.load_finder)
+            if self.workers != 1:
+                # Forked workers need all the matchers
+                self.forked_matcher = await loop.run_in_executor(
+                    self.executor, automata.ForkedMatcher, finder, self.workers or None)
+        except Exception as ex:
+            logger.exception('loading the index failed')
+            self.loading_error = ex
+            return
+        self.finder = finder
+        logger.info('index loaded in %.1fs', time.time() - started)
+        try:
+            await loop.run_in_executor(None, finder.completed)
+        except Exception as ex:
+            self.loading_error = ex
+            return
+        logger.info('index built in %.1fs', time.time() - started)
+
+    def matchers_ready(self):
+        return dict((matcher, self.finder is not None and self.finder.is_ready(matcher))
+                    for matcher in automata.Finder.MATCHERS)
+
+    async def close(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+        if self.forked_matcher is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.forked_matcher.close)
+        self.executor.shutdown(wait=False)
+
+    async def match(self, name, data_sources=()):
+        # `(branch, names)` of the query, shared with the identical queries in flight
+        if not self.ready:
+            raise NotReady()
+        self.counters['requests'] += 1
+        key = (automata.clean_word(name), frozenset(data_sources))
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counters['coalesced'] += 1
+        else:
+            if len(self.in_flight) >= self.max_pending:
+                self.counters['overloaded'] += 1
+                raise Overloaded()
+            future = asyncio.get_event_loop().create_future()
+            self.in_flight[key] = future
+            self.queue.put_nowait(key)
+        try:
+            # Shielded: a timeout of this request does not cancel the query of the others
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            raise
+
+    async def _batch_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self.counters['batches'] += 1
+            self.counters['batched_queries'] += len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self._match_batch, batch)
+            except Exception as ex:
+                for key in batch:
+                    self.in_flight.pop(key).set_exception(ex)
+                continue
+            for key, result in zip(batch, results):
+                if isinstance(result, automata.IndexNotReady):
+                    self.in_flight.pop(key).set_exception(result)
+                else:
+                    self.in_flight.pop(key).set_result(result)
+
+    def _match_batch(self, batch):
+        # `(branch, names)` of every query of `batch`, or `automata.IndexNotReady` when it needs a
+        # matcher that is not built yet
+        if self.forked_matcher is not None:
+            return self.forked_matcher.map(batch, max(1, len(batch) // self.forked_matcher.workers))
+        results = []
+        for word, data_sources in batch:
+            try:
+                results.append(self.finder.find_all_matches_with_branch(word, data_sources))
+            except automata.IndexNotReady as ex:
+                results.append(ex)
+        return results
+
+    def stats(self):
+        stats = dict(self.counters, ready=self.ready, matchers=self.matchers_ready(), in_flight=len(self.in_flight))
+        if self.finder is not None:
+            stats['cache'] = self.finder.cache_stats()
+        return stats
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            429: 'Too Many Requests', 500: 'Internal Server Error', 503: 'Service Unavailable',
+            504: 'Gateway Timeout'}
+
+
+async def _read_request(reader):
+    # Method, target, headers and body of the next request, None at the end of the connection
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, version = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        header, _, value = line.decode('latin-1').partition(':')
+        headers[header.strip().lower()] = value.strip()
+    body = b''
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+    return method, target, body, keep_alive
+
+
+async def _respond(service, method, target, body):
+    # Status and JSON document of a request
+    url = urlsplit(target)
+    if url.path == '/ready':
+        matchers = service.matchers_ready()
+        if all(matchers.values()):
+            return 200, {'ready': True, 'matchers': matchers}
+        return 503, {'ready': False, 'matchers': matchers,
+                     'error': str(service.loading_error) if service.loading_error else None}
+    if url.path == '/stats':
+        return 200, service.stats()
+    if url.path != '/match':
+        return 404, {'error': 'not found'}
+
+    if method == 'GET':
+        query = parse_qs(url.query)
+        names = query.get('name')
+        if not names:
+            return 400, {'error': 'name is required'}
+        name = names[0]
+        data_sources = [int(data_source) for data_source in query.get('data_source', [])]
+    elif method == 'POST':
+        request = json.loads(body.decode('utf-8'))
+        if not isinstance(request, dict):
+            return 400, {'error': 'request must be a JSON object'}
+        name = request.get('name')
+        if not name or not isinstance(name, str):
+            return 400, {'error': 'name is required'}
+        data_sources = request.get('data_sources') or []
+        if not isinstance(data_sources, list) or \
+                not all(isinstance(data_source, int) and not isinstance(data_source, bool)
+                        for data_source in data_sources):
+            return 400, {'error': 'data_sources must be a list of integers'}
+    else:
+        return 405, {'error': 'method not allowed'}
+
+    try:
+        branch, matches = await service.match(name, data_sources)
+    except NotReady:
+        return 503, {'error': 'index is loading'}
+    except automata.IndexNotReady as ex:
+        return 503, {'error': '%s matcher is being built' % ex}
+    except Overloaded:
+        return 429, {'error': 'too many pending queries'}
+    except asyncio.TimeoutError:
+        return 504, {'error': 'timed out'}
+    return 200, {'name': name, 'data_sources': sorted(data_sources), 'branch': branch, 'matches': sorted(matches)}
+
+
+async def handle_connection(service, reader, writer):
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                request = None
+            if request is None:
+                break
+            method, target, body, keep_alive = request
+            try:
+                status, document = await _respond(service, method, target, body)
+            except ValueError as ex:
+                status, document = 400, {'error': str(ex)}
+            except Exception as ex:
+                logger.exception('request %s %s failed', method, target)
+                status, document = 500, {'error': str(ex)}
+            payload = json.dumps(document, sort_keys=True).encode('utf-8')
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                          'Connection: %s\r\n\r\n' % (status, _REASONS[status], len(payload),
+                                                      'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+            writer.write(payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service, host='127.0.0.1', port=8080):
+    # Starts `service` and its HTTP server, returns the `asyncio` server
+    await service.start()
+    return await asyncio.start_server(lambda reader, writer: handle_connection(service, reader, writer), host, port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HTTP matching server')
+    index = parser.add_mutually_exclusive_group(required=True)
+    index.add_argument('--snapshot', help='snapshot written by Finder.save')
+    index.add_argument('--catalogue', help='catalogue file: a name, a tab and comma separated datasource ids')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-delay', type=float, default=0.005, help='seconds to wait to fill a batch')
+    parser.add_argument('--max-pending', type=int, default=10000, help='distinct queries waiting at most')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request fails')
+    parser.add_argument('--workers', type=int, default=1, help='matching processes, 0 for one per core')
+    parser.add_argument('--build-workers', type=int, default=1,
+                        help='processes building the index from a catalogue, 0 for one per core')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.snapshot:
+        def load_finder():
+            return automata.Finder.load(args.snapshot)
+    else:
+        def load_finder():
+            import stream_matcher
+            return automata.Finder(stream_matcher.load_catalogue(args.catalogue),
+                                   build_workers=args.build_workers or None, wait=False)
+    service = MatchService(load_finder, args.max_batch_size, args.max_delay, args.max_pending, args.timeout,
+                           args.workers)
+
+    async def run():
+        server = await serve(service, args.host, args.port)
+        logger.info('listening on %s:%d', args.host, args.port)
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            await service.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
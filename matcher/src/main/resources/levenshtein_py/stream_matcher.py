@@ -0,0 +1,112 @@
+"""Streaming matcher: one JSON line of matches for every input name.
+
+The index is a snapshot written by `automata.Finder.save`, or a catalogue to build one from, with
+a name and its comma separated datasource ids on every line separated by a tab. Names are read
+from a file or stdin, one per line, or as JSON objects `{"name": ..., "data_sources": [...]}` with
+`--json-input`. Input is read in blocks of `--chunk-size` names per worker, so memory does not
+grow with the input, and the output keeps the input order:
+
+    python -m stream_matcher --snapshot finder.snapshot --data-source 1 < names.txt > matches.ndjson
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import itertools
+import json
+import logging
+import sys
+
+import automata
+
+
+def load_catalogue(path):
+    # `words_to_datasources` of a catalogue file
+    words_to_datasources = {}
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            name, _, data_sources = line.partition('\t')
+            words_to_datasources[name] = set(int(data_source) for data_source in data_sources.split(',')
+                                             if data_source.strip())
+    return words_to_datasources
+
+
+def read_queries(lines, data_sources, json_input=False):
+    # `(name, data_sources)` of every non empty input line
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        if json_input:
+            query = json.loads(line)
+            yield query['name'], set(query.get('data_sources') or data_sources)
+        else:
+            yield line, data_sources
+
+
+def match_queries(finder, queries, workers=1, chunk_size=1000):
+    # `(name, data_sources, branch, matches)` of every query, in order. With more than one worker,
+    # blocks of `workers * chunk_size` queries are matched by a `ForkedMatcher`.
+    if workers == 1:
+        for name, data_sources in queries:
+            branch, matches = finder.find_all_matches_with_branch(name, data_sources)
+            yield name, data_sources, branch, matches
+        return
+
+    with automata.ForkedMatcher(finder, workers) as matcher:
+        block_size = matcher.workers * chunk_size
+        while True:
+            block = list(itertools.islice(queries, block_size))
+            if not block:
+                break
+            for (name, data_sources), (branch, matches) in zip(block, matcher.map(block, chunk_size)):
+                yield name, data_sources, branch, matches
+
+
+def _open_input(path):
+    if path is None or path == '-':
+        if sys.version_info[0] < 3:
+            return io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+        return sys.stdin
+    return io.open(path, encoding='utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Match names from a file or stdin, one JSON line per name')
+    index = parser.add_mutually_exclusive_group(required=True)
+    index.add_argument('--snapshot', help='snapshot written by Finder.save')
+    index.add_argument('--catalogue', help='catalogue file: a name, a tab and comma separated datasource ids')
+    parser.add_argument('--input', help='file with the names to match, stdin by default')
+    parser.add_argument('--json-input', action='store_true',
+                        help='input lines are JSON objects with "name" and optional "data_sources"')
+    parser.add_argument('--data-source', type=int, action='append', default=[],
+                        help='datasource to filter by, may be repeated')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes building the index and matching, 0 for one per core')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='names sent to a worker at a time')
+    parser.add_argument('--verbose', action='store_true', help='log the index construction')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if args.snapshot:
+        finder = automata.Finder.load(args.snapshot)
+    else:
+        finder = automata.Finder(load_catalogue(args.catalogue), build_workers=args.workers or None)
+
+    input_file = _open_input(args.input)
+    try:
+        queries = read_queries(input_file, set(args.data_source), args.json_input)
+        for name, data_sources, branch, matches in match_queries(finder, queries, args.workers or None,
+                                                                 args.chunk_size):
+            print(json.dumps({'name': name, 'data_sources': sorted(data_sources), 'branch': branch,
+                              'matches': sorted(matches)}, sort_keys=True))
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+
+if __name__ == '__main__':
+    main()
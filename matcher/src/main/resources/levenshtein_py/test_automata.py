@@ -0,0 +1,446 @@
+"""Regression tests of `automata` against the straightforward implementations it replaced.
+
+    python -m pytest matcher/src/main/resources/levenshtein_py
+"""
+import random
+from itertools import combinations
+
+import pytest
+
+import automata
+import benchmark
+
+
+def _levenshtein(s1, s2):
+    # Full dynamic programming edit distance
+    previous_row = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            current_row.append(min(previous_row[j + 1] + 1, current_row[j] + 1, previous_row[j] + (c1 != c2)))
+        previous_row = current_row
+    return previous_row[-1]
+
+
+def _threshold_helper(word_input, word_candidate, space_edits):
+    for idx, (input_part, candidate_part) in enumerate(zip(word_input.split(' '), word_candidate.split(' '))):
+        if _levenshtein(input_part, candidate_part) + space_edits[idx] > automata._allowed_edits(len(input_part)):
+            return False
+    return True
+
+
+def _matching_threshold(word_input, word_candidate):
+    # Threshold of the original matcher: tries every way of gluing the parts of the word with more
+    # spaces with `combinations`
+    word_input_spaces = word_input.count(' ')
+    word_candidate_spaces = word_candidate.count(' ')
+    if word_input_spaces == word_candidate_spaces:
+        return _threshold_helper(word_input, word_candidate, [0] * (word_input_spaces + 1))
+
+    input_longer = word_input_spaces > word_candidate_spaces
+    word_long, word_short, word_long_spaces, word_short_spaces = \
+        (word_input, word_candidate, word_input_spaces, word_candidate_spaces) if input_longer \
+        else (word_candidate, word_input, word_candidate_spaces, word_input_spaces)
+    word_long_parts = word_long.split(' ')
+    for comb in combinations(range(word_long_spaces), word_short_spaces):
+        word_long_idx = 0
+        word_long_new = ''
+        space_edits = [-1] * (word_short_spaces + 1)
+        for i, c in enumerate(comb):
+            while word_long_idx <= c:
+                word_long_new += word_long_parts[word_long_idx]
+                space_edits[i] += 1
+                word_long_idx += 1
+            word_long_new += ' '
+        word_long_new += ''.join(word_long_parts[word_long_idx:])
+        space_edits[-1] += len(word_long_parts[word_long_idx:])
+        pair = (word_long_new, word_short) if input_longer else (word_short, word_long_new)
+        if _threshold_helper(pair[0], pair[1], space_edits):
+            return True
+    return False
+
+
+def _random_word(rnd, alphabet, min_length, max_length):
+    return ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(min_length, max_length)))
+
+
+def _mutate(rnd, word, alphabet):
+    idx = rnd.randrange(len(word) + 1)
+    edit = rnd.random()
+    if edit < 0.3 and idx < len(word):
+        return word[:idx] + word[idx + 1:]
+    if edit < 0.6 and idx < len(word):
+        return word[:idx] + rnd.choice(alphabet) + word[idx + 1:]
+    return word[:idx] + rnd.choice(alphabet) + word[idx:]
+
+
+@pytest.fixture(scope='module')
+def catalogue():
+    return benchmark.build_catalogue(benchmark.load_words(), 1500)
+
+
+@pytest.fixture(scope='module')
+def queries(catalogue):
+    return [query for _, query in benchmark.make_queries(catalogue, 300, seed=5)]
+
+
+@pytest.mark.parametrize('max_edits', [1, 2])
+def test_levenshtein_dfa_matches_dp(max_edits):
+    rnd = random.Random(max_edits)
+    for _ in range(3000):
+        term = _random_word(rnd, 'abc', 0, 10)
+        candidate = _random_word(rnd, 'abc', 0, 12)
+        lev = automata.levenshtein_automata(term, max_edits)
+        state = lev.start_state
+        bounds = [lev.min_distance(state)]
+        for c in candidate:
+            state = lev.next_state(state, c)
+            if state is None:
+                break
+            bounds.append(lev.min_distance(state))
+        distance = _levenshtein(term, candidate)
+        assert lev.is_final(state) == (distance <= max_edits), (term, candidate)
+        assert bounds == sorted(bounds), (term, candidate)
+        if lev.is_final(state):
+            assert lev.distance(state) == distance, (term, candidate)
+            assert bounds[-1] <= distance, (term, candidate)
+
+
+def _accepts(automaton, word):
+    state = automaton.start_state
+    for c in word:
+        state = automaton.next_state(state, c)
+        if state is None:
+            return False
+    return automaton.is_final(state)
+
+
+def test_part_budget_automaton_matches_threshold():
+    rnd = random.Random(3)
+    for _ in range(3000):
+        term = ' '.join(_random_word(rnd, 'abcde', 0, 13) for _ in range(rnd.randint(1, 4)))
+        candidate = term
+        for _ in range(rnd.randint(0, 4)):
+            candidate = _mutate(rnd, candidate, 'abcde ')
+        if candidate:
+            assert _accepts(automata.PartBudgetAutomaton(term), candidate) == \
+                _matching_threshold(term, candidate), (term, candidate)
+
+
+def test_part_budgets_give_the_same_matches(catalogue, queries):
+    finder = automata.Finder(catalogue, cache_size=0)
+    budgets = automata.Finder(catalogue, cache_size=0, part_budgets=True)
+    for query in queries:
+        for data_sources in (set(), {1, 2}):
+            branch, matches = finder.find_all_matches_with_branch(query, data_sources)
+            budgets_branch, budgets_matches = budgets.find_all_matches_with_branch(query, data_sources)
+            assert (budgets_branch, sorted(budgets_matches)) == (branch, sorted(matches)), (query, data_sources)
+
+
+def test_matching_alignment_matches_combinations():
+    rnd = random.Random(1)
+    alphabet = 'abcde  '
+    for _ in range(3000):
+        term = ' '.join(_random_word(rnd, 'abcde', 0, 13) for _ in range(rnd.randint(1, 5)))
+        candidate = term
+        for _ in range(rnd.randint(0, 5)):
+            candidate = _mutate(rnd, candidate, alphabet)
+        alignment = automata._matching_alignment(term, candidate)
+        assert (alignment is not None) == _matching_threshold(term, candidate), (term, candidate)
+        if alignment is not None:
+            assert ''.join(part for part, _, _ in alignment) == term.replace(' ', '')
+            assert ''.join(part for _, part, _ in alignment) == candidate.replace(' ', '')
+            assert len(alignment) == min(term.count(' '), candidate.count(' ')) + 1
+
+
+def test_bounded_levenshtein_matches_dp():
+    rnd = random.Random(2)
+    for _ in range(5000):
+        word = _random_word(rnd, 'abcd', 0, 12)
+        candidate = _random_word(rnd, 'abcd', 0, 12)
+        max_edits = rnd.randint(0, 4)
+        assert automata._bounded_levenshtein(word, candidate, max_edits) == \
+            min(_levenshtein(word, candidate), max_edits + 1), (word, candidate, max_edits)
+        candidates = [candidate, word[::-1], candidate + word]
+        assert automata._bounded_levenshtein_many(word, candidates, max_edits) == \
+            [min(_levenshtein(word, c), max_edits + 1) for c in candidates]
+
+
+def _stem(word):
+    # Stem and suffix of the original stemmer: tries every suffix in order
+    word = word.replace('j', 'i').replace('v', 'u')
+    if word.endswith('que'):
+        if word in automata.LatinStemmer._LatinStemmer__que_exceptions:
+            return word, ''
+        word = word[:-3]
+    for suffix in automata.LatinStemmer._LatinStemmer__noun_suffixes:
+        if word.endswith(suffix):
+            if len(word) - len(suffix) >= 2:
+                return word[:-len(suffix)], suffix
+            return word, ''
+    return word, ''
+
+
+def test_latin_stemmer_matches_suffix_scan():
+    words = benchmark.load_words(min_length=1)
+    words += [word + suffix for word in words[::10] for suffix in ('que', 'ibus', 'ius', 'ia', 'a', 'um')]
+    words += ['', 'a', 'us', 'ius', 'ibus', 'que', 'aque', 'atque', 'iusque', 'jvs', 'vjibus', 'quaeque', 'xque']
+    expected = [_stem(word) for word in words]
+    # Twice, the second time from the memo
+    for _ in range(2):
+        assert [(stem.stem, stem.suffix) for stem in map(automata.LatinStemmer.stemmize, words)] == expected
+    assert [(stem.stem, stem.suffix) for stem in automata.LatinStemmer.stemmize_many(words + words)] == \
+        expected + expected
+    names = ['Abies ' + word for word in words[::7]] + ['Abies alba jvnior vque', 'Abies', 'Abies  alba']
+    assert automata.MatcherByStem.transform_many(names) == [automata.MatcherByStem.transform(name) for name in names]
+    assert automata.MatcherByStem.transform('Abies alba jvnior') == 'abies alb iunior'
+
+
+def test_snapshot_round_trip(catalogue, queries, tmpdir):
+    # Abbreviated queries need the tuple tags of `MatcherByLetter`, the options add the q-gram
+    # filter and combined trie sections
+    catalogue = dict(catalogue)
+    catalogue.update({u'Ab\xefes alb\xe0': {1, 2}, u'\xc6rva lan\xe1ta': {3}, u'\xc6rva': {3}, u'Aerva lanata': {4}})
+    queries = queries + [u'Ab\xefes alb\xe0', u'A. alb\xe0', u'\xc6rva lan\xe1to', u'\xc6. lanata', u'\xc6rva']
+    path = str(tmpdir.join('finder.snapshot'))
+    for options in ({}, {'gram_filter': True, 'combined_search': True, 'exact_first': True}):
+        finder = automata.Finder(catalogue, cache_size=0, **options)
+        finder.save(path)
+        loaded = automata.Finder.load(path, cache_size=0)
+        for option, value in options.items():
+            assert getattr(loaded, option) == value
+        if options:
+            assert isinstance(loaded.combined_trie, automata.TaggedTrie)
+            assert isinstance(loaded.matcher_by_letter.finder.combined_trie, automata.TaggedTrie)
+            assert loaded.matcher_by_stem.gram_filter is not None
+        for query in queries:
+            for data_sources in (set(), {1, 3}):
+                branch, matches = loaded.find_all_matches_with_branch(query, data_sources)
+                expected_branch, expected_matches = finder.find_all_matches_with_branch(query, data_sources)
+                assert (branch, sorted(matches)) == (expected_branch, sorted(expected_matches)), query
+                assert loaded.find_all_candidates(query, data_sources, 3) == \
+                    finder.find_all_candidates(query, data_sources, 3), query
+
+
+def _assert_same_matches(finder, expected, queries):
+    for query in queries:
+        for data_sources in (set(), {3}, {4, 5}):
+            branch, matches = finder.find_all_matches_with_branch(query, data_sources)
+            expected_branch, expected_matches = expected.find_all_matches_with_branch(query, data_sources)
+            assert sorted(matches) == sorted(expected_matches), (query, data_sources)
+            if expected_matches:
+                assert branch == expected_branch, (query, data_sources)
+
+
+def test_updates_match_rebuilt_finder(catalogue, queries):
+    rnd = random.Random(3)
+    extra = dict((name + 'a', data_sources) for name, data_sources in sorted(catalogue.items())[::7])
+    finder = automata.Finder(catalogue, cache_size=100)
+    current = dict(catalogue)
+    initial = finder._index[0]
+    merged = False
+    for _ in range(6):
+        with finder.updating():
+            for _ in range(rnd.randint(1, 60)):
+                edit = rnd.random()
+                if edit < 0.4:
+                    name = rnd.choice(sorted(extra))
+                    current[name] = set(rnd.sample(range(1, 12), 2))
+                    finder.add_name(name, current[name])
+                elif edit < 0.7:
+                    name = rnd.choice(sorted(current))
+                    finder.remove_name(name)
+                    del current[name]
+                else:
+                    name = rnd.choice(sorted(current))
+                    current[name] = {rnd.randint(1, 11)}
+                    finder.update_datasources(name, current[name])
+        indexes = finder._index[0]
+        if indexes is not initial:
+            merged = True
+            # The names and matchers of the finder are the ones of the merged indexes
+            assert finder.names is indexes.names
+            assert finder.matcher_by_stem is indexes.matcher_by_stem
+        _assert_same_matches(finder, automata.Finder(current), queries + sorted(extra)[:20])
+    assert merged
+
+    with pytest.raises(KeyError):
+        finder.remove_name('Nonexistent name')
+
+
+class _MergeOnWalk(automata.Instrumentation):
+    # Removes `names` from `finder` in the middle of the first walk of a query
+
+    def __init__(self, finder, names):
+        self.finder = finder
+        self.names = names
+
+    def stage(self, name, started):
+        if name == 'walk' and self.names:
+            names, self.names = self.names, None
+            with self.finder.updating():
+                for removed in names:
+                    self.finder.remove_name(removed)
+
+
+def test_merge_during_query_keeps_its_indexes(catalogue):
+    names = sorted(catalogue, key=lambda name: (' ' not in name, name))
+    query = names[0][:-1] + 'x'
+    finder = automata.Finder(catalogue, cache_size=0)
+    expected = finder.find_all_matches_with_branch(query)
+    assert names[0] in expected[1]
+    removed = names[:200]
+    initial = finder._index[0]
+    finder.set_instrumentation(_MergeOnWalk(finder, removed))
+    branch, matches = finder.find_all_matches_with_branch(query)
+    assert finder._index[0] is not initial
+    # The query answers from the indexes it started with
+    assert (branch, sorted(matches)) == (expected[0], sorted(expected[1]))
+    rebuilt = automata.Finder(dict((name, catalogue[name]) for name in names[200:]))
+    _assert_same_matches(finder, rebuilt, [query] + names[:5] + names[200:205])
+
+
+def test_batch_matches_single_queries(catalogue, queries):
+    finder = automata.Finder(catalogue)
+    words = queries[:60] + queries[:20]
+    expected = [finder.find_all_matches(word, {1, 2}) for word in words]
+    for workers, chunk_size in ((1, 1000), (2, 7)):
+        matches = finder.find_all_matches_batch(words, {1, 2}, workers, chunk_size)
+        assert [sorted(res) for res in matches] == [sorted(res) for res in expected]
+        # Equal words do not share their results
+        matches[0].append('changed')
+        assert 'changed' not in matches[60]
+
+
+def test_limited_results_are_the_closest(catalogue, queries):
+    for options in ({}, {'part_budgets': True}):
+        finder = automata.Finder(catalogue, cache_size=0, **options)
+        for query in queries:
+            for data_sources in (set(), {1, 2}):
+                branch, matches = finder.find_all_matches_with_branch(query, data_sources)
+                candidates = finder.find_all_candidates(query, data_sources)
+                assert sorted(candidate.term for candidate in candidates) == sorted(matches), query
+                distances = [candidate.distance for candidate in candidates]
+                assert distances == sorted(distances), query
+                for limit in (1, 3, 10):
+                    limited = finder.find_all_candidates(query, data_sources, limit)
+                    assert set(candidate.term for candidate in limited) <= set(matches), (query, limit)
+                    assert [candidate.distance for candidate in limited] == distances[:limit], (query, limit)
+                    limited_branch, _ = finder.find_all_matches_with_branch(query, data_sources, limit)
+                    if matches:
+                        assert limited_branch == branch, (query, limit)
+
+
+@pytest.mark.parametrize('options', [{}, {'prefix_length': 4}, {'prefix_length': 12}, {'max_distance': 1},
+                                     {'max_distance': 1, 'prefix_length': 5}])
+def test_symmetric_delete_engine_matches_automaton(catalogue, queries, options):
+    # Below the 2 edits of the automata, only the matches further than `max_distance` are lost
+    finder = automata.Finder(catalogue, cache_size=0)
+    engine = automata.Finder(catalogue, cache_size=0, engine=automata.new_engine('symmetric_delete', **options))
+    exact = options.get('max_distance', 2) >= 2
+    for query in queries:
+        for data_sources in (set(), {1, 2}):
+            branch, matches = engine.find_all_matches_with_branch(query, data_sources)
+            expected_branch, expected_matches = finder.find_all_matches_with_branch(query, data_sources)
+            candidates = [(candidate.term, candidate.distance)
+                          for candidate in engine.find_all_candidates(query, data_sources)]
+            expected_candidates = [(candidate.term, candidate.distance)
+                                   for candidate in finder.find_all_candidates(query, data_sources)]
+            if exact:
+                assert (branch, sorted(matches)) == (expected_branch, sorted(expected_matches)), query
+                assert sorted(candidates) == sorted(expected_candidates), query
+            else:
+                assert set(matches) <= set(expected_matches), query
+                assert sorted(candidate for candidate in candidates if candidate[1] <= 1) == \
+                    sorted(candidate for candidate in expected_candidates if candidate[1] <= 1), query
+
+
+def test_tagged_trie_walk_matches_separate_tries(catalogue, queries):
+    finder = automata.Finder(catalogue, cache_size=0)
+    stem, verbatim = finder.matcher_by_stem, finder.matcher_by_verbatim
+    trie = automata.TaggedTrie(stem.trie, verbatim.trie)
+    mask = finder.names.mask({1, 2})
+    for query in queries:
+        word = automata.clean_word(query)
+        # Both automata share their steps while the stem and the verbatim terms agree
+        stem_lev = automata.levenshtein_automata(stem.transform(word))
+        verbatim_lev = automata.levenshtein_automata(verbatim.transform(word))
+        for query_mask in (None, mask):
+            stem_keys = sorted(stem.trie.find_all(stem_lev, query_mask))
+            verbatim_keys = sorted(verbatim.trie.find_all(verbatim_lev, query_mask))
+            tagged_stem, tagged_verbatim = trie.find_all_tagged(stem_lev, verbatim_lev, query_mask)
+            assert sorted(tagged_stem) == stem_keys, query
+            assert (sorted(tagged_verbatim) if tagged_verbatim is not None else None) == \
+                (None if stem_keys else verbatim_keys), query
+            assert trie.find_all_tagged(stem_lev, None, query_mask)[0] == tagged_stem, query
+            assert sorted(trie.find_all_tagged(None, verbatim_lev, query_mask)[1]) == verbatim_keys, query
+
+
+def test_combined_search_matches_sequential(catalogue, queries):
+    # Removing 'Abies grandiflora' hides the only stem match of 'Abies grandiflorus', so the
+    # verbatim matches the combined walk skipped are searched again
+    catalogue = dict(catalogue)
+    catalogue.update({'Abies grandiflora': {1}, 'Abies grandiflorux': {2}})
+    queries = queries + ['', 'Abies grandiflorus']
+    names = sorted(catalogue)
+    for options in ({}, {'part_budgets': True}, {'gram_filter': True}):
+        finder = automata.Finder(catalogue, cache_size=0, **options)
+        combined = automata.Finder(catalogue, cache_size=0, combined_search=True, **options)
+        assert combined.find_all_matches_with_branch('Abies grandiflorus') == ('stem', ['Abies grandiflora'])
+        for updated in (False, True):
+            if updated:
+                for each in (finder, combined):
+                    with each.updating():
+                        for name in sorted(set(names[::30]) | {'Abies grandiflora'}):
+                            each.remove_name(name)
+                        for name in names[1::150]:
+                            each.add_name(name + 'a', {1, 3})
+                assert combined._index[2]
+                branch, matches = combined.find_all_matches_with_branch('Abies grandiflorus')
+                assert (branch, 'Abies grandiflorux' in matches) == ('verbatim', True)
+            for query in queries:
+                for data_sources in (set(), {1, 2}):
+                    assert combined.find_all_matches_with_branch(query, data_sources) == \
+                        finder.find_all_matches_with_branch(query, data_sources), (query, data_sources)
+
+
+def test_sharded_finder_matches_finder(catalogue, queries):
+    # The j/i and v/u spellings of a genus go to the same shard
+    catalogue = dict(catalogue)
+    catalogue.update({u'Juniperus': {1}, u'Iuniperus communis': {2}, u'Vulpes': {3}, u'Julus alba': {4}})
+    queries = queries + ['', 'Iuniperus', 'J. communis', 'Uulpes', 'I. communis', 'xx']
+    finder = automata.Finder(catalogue, cache_size=0)
+    with automata.ShardedFinder(catalogue, shards=3, cache_size=0) as sharded:
+        assert sum(sharded.sizes) == len(catalogue)
+        for query in queries:
+            for data_sources in (set(), {1, 2}):
+                branch, matches = sharded.find_all_matches_with_branch(query, data_sources)
+                expected_branch, expected_matches = finder.find_all_matches_with_branch(query, data_sources)
+                assert (branch, sorted(matches)) == (expected_branch, sorted(expected_matches)), query
+                assert sorted(candidate.term for candidate in sharded.find_all_candidates(query, data_sources)) == \
+                    sorted(expected_matches), query
+                assert [(candidate.distance, candidate.branch)
+                        for candidate in sharded.find_all_candidates(query, data_sources, 3)] == \
+                    [(candidate.distance, candidate.branch)
+                     for candidate in finder.find_all_candidates(query, data_sources, 3)], query
+        batch = sharded.map([(query, set()) for query in queries])
+        assert [(branch, sorted(matches)) for branch, matches in batch] == \
+            [(branch, sorted(matches)) for branch, matches in map(finder.find_all_matches_with_branch, queries)]
+
+
+def test_sharded_exact_tier_matches_finder(catalogue, queries):
+    # The exact tier of one shard wins over the fuzzy matches of the others, stems first
+    catalogue = dict(catalogue)
+    catalogue.update({'Abcdefgh xyzzy': {1}, 'Bbcdefgh xyzzy': {1}, 'Jbcdefgh xyzzy': {2}, 'Kbcdefgh xyzzy': {2}})
+    queries = queries + ['Abcdefgh xyzzy', 'Ibcdefgh xyzzy', 'Kbcdefgh xyzzy']
+    finder = automata.Finder(catalogue, exact_first=True)
+    assert finder.find_all_matches_with_branch('Abcdefgh xyzzy') == ('stem', ['Abcdefgh xyzzy'])
+    with automata.ShardedFinder(catalogue, shards=4, exact_first=True) as sharded:
+        assert len(set(automata.shard_of(name, 4) for name in ('A', 'B', 'I', 'K'))) > 1
+        for query in queries:
+            branch, matches = sharded.find_all_matches_with_branch(query)
+            expected_branch, expected_matches = finder.find_all_matches_with_branch(query)
+            assert (branch, sorted(matches)) == (expected_branch, sorted(expected_matches)), query
+            assert [(candidate.term, candidate.distance) for candidate in sharded.find_all_candidates(query, limit=3)] \
+                == [(candidate.term, candidate.distance) for candidate in finder.find_all_candidates(query, limit=3)], \
+                query
@@ -0,0 +1,121 @@
+"""Tests of `match_server` over a localhost connection.
+
+    python -m pytest matcher/src/main/resources/levenshtein_py
+"""
+import asyncio
+import json
+import threading
+import time
+
+import automata
+import match_server
+
+CATALOGUE = {'Abies alba': {1}, 'Abies alpina': {2}, 'Aerva lanata': {1, 2}}
+
+
+async def _request(port, method, target, body=None):
+    # Status and JSON document of one request on its own connection
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    writer.write(('%s %s HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                  % (method, target, len(payload))).encode('latin-1') + payload)
+    response = await reader.read()
+    writer.close()
+    head, _, document = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(document.decode('utf-8'))
+
+
+def _slow_finder(seconds):
+    # Finder taking `seconds` for every query
+    finder = automata.Finder(CATALOGUE)
+    find = finder.find_all_matches_with_branch
+
+    def slow_find(word, data_sources=None):
+        time.sleep(seconds)
+        return find(word, data_sources)
+
+    finder.find_all_matches_with_branch = slow_find
+    return finder
+
+
+def _run(service, test):
+    # Runs `test(port)` against `service` served on a free port
+    async def run():
+        server = await match_server.serve(service, port=0)
+        try:
+            await test(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+            await service.close()
+
+    asyncio.run(run())
+
+
+async def _until_ready(port):
+    for _ in range(500):
+        status, _ = await _request(port, 'GET', '/ready')
+        if status == 200:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('not ready')
+
+
+def test_ready_once_loaded():
+    loaded = threading.Event()
+
+    def load_finder():
+        loaded.wait(10)
+        return automata.Finder(CATALOGUE)
+
+    async def test(port):
+        try:
+            status, document = await _request(port, 'GET', '/ready')
+            assert (status, document['ready']) == (503, False)
+            assert (await _request(port, 'GET', '/match?name=Abies+alba'))[0] == 503
+        finally:
+            loaded.set()
+        await _until_ready(port)
+        status, document = await _request(port, 'GET', '/match?name=Abies+alba&data_source=1')
+        assert (status, document['matches']) == (200, ['Abies alba'])
+
+    _run(match_server.MatchService(load_finder), test)
+
+
+def test_invalid_requests_are_refused():
+    async def test(port):
+        await _until_ready(port)
+        for body in ([1], 'Abies alba', {'name': 1}, {'name': 'Abies alba', 'data_sources': [1, 'a']},
+                     {'name': 'Abies alba', 'data_sources': 1}):
+            assert (await _request(port, 'POST', '/match', body))[0] == 400, body
+        assert (await _request(port, 'GET', '/match?name=Abies+alba&data_source=a'))[0] == 400
+        status, document = await _request(port, 'POST', '/match', {'name': 'Abies alba', 'data_sources': [2, 1]})
+        assert (status, document['data_sources']) == (200, [1, 2])
+
+    _run(match_server.MatchService(lambda: automata.Finder(CATALOGUE)), test)
+
+
+def test_identical_queries_are_coalesced():
+    service = match_server.MatchService(lambda: _slow_finder(0.1))
+
+    async def test(port):
+        await _until_ready(port)
+        responses = await asyncio.gather(*[_request(port, 'GET', '/match?name=Abies+albus') for _ in range(5)])
+        assert [status for status, _ in responses] == [200] * 5
+        assert all(document == responses[0][1] for _, document in responses)
+        assert service.counters['coalesced'] == 4
+        assert service.counters['batched_queries'] == 1
+
+    _run(service, test)
+
+
+def test_overload_and_timeout():
+    service = match_server.MatchService(lambda: _slow_finder(0.3), max_delay=0.05, max_pending=1, timeout=0.1)
+
+    async def test(port):
+        await _until_ready(port)
+        statuses = await asyncio.gather(_request(port, 'GET', '/match?name=Abies+alba'),
+                                        _request(port, 'GET', '/match?name=Aerva+lanata'))
+        assert sorted(status for status, _ in statuses) == [429, 504]
+        assert (service.counters['overloaded'], service.counters['timeouts']) == (1, 1)
+
+    _run(service, test)
@@ -0,0 +1,25 @@
+"""Tests of `stream_matcher`.
+
+    python -m pytest matcher/src/main/resources/levenshtein_py
+"""
+import os
+import time
+
+import automata
+import stream_matcher
+
+
+def _pid_chunk(queries):
+    # Stands for `automata._match_chunk` in the workers: the pid of the worker as the branch
+    time.sleep(0.05)
+    return [(os.getpid(), [])] * len(queries)
+
+
+def test_default_workers_share_the_blocks(monkeypatch):
+    monkeypatch.setattr(automata._fork_context(), 'cpu_count', lambda: 4)
+    monkeypatch.setattr(automata, '_match_chunk', _pid_chunk)
+    finder = automata.Finder({'Abies alba': {1}})
+    queries = iter([('Abies alba', set())] * 40)
+    results = list(stream_matcher.match_queries(finder, queries, None, 2))
+    assert len(results) == 40
+    assert len(set(branch for _, _, branch, _ in results)) > 1